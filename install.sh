@@ -4,4 +4,11 @@ echo
 echo 'Initiating the Cassandra tables ...'
 echo
 
-cqlsh ${MORPHL_SERVER_IP_ADDRESS} -u morphl -p ${MORPHL_CASSANDRA_PASSWORD} -f /opt/ga_epna/cassandra_schema/ga_epna_cassandra_schema.cql
\ No newline at end of file
+cqlsh ${MORPHL_SERVER_IP_ADDRESS} -u morphl -p ${MORPHL_CASSANDRA_PASSWORD} -f /opt/ga_epna/cassandra_schema/ga_epna_cassandra_schema.cql
+
+echo 'Copying the model metadata next to the model weights ...'
+echo
+
+# Keep the metadata already shipped with the deployed weights, if any.
+mkdir -p /opt/models
+cp -n /opt/ga_epna/prediction/models/ga_epna_model_metadata.json /opt/models/ga_epna_model_metadata.json
@@ -1,6 +1,11 @@
+import json
+from functools import reduce
 from os import getenv
-from pyspark.sql import functions as f, SparkSession, Window
-from pyspark.sql.types import ArrayType, DoubleType
+import numpy as np
+from pyspark.sql import functions as f, DataFrame, SparkSession, Window
+from pyspark.sql.types import BinaryType
+
+from ga_epna_skew_join import get_skewed_keys, skew_aware_join
 
 
 HDFS_PORT = 9000
@@ -19,6 +24,35 @@ HDFS_DIR_USER_FILTERED = f'hdfs://{MORPHL_SERVER_IP_ADDRESS}:{HDFS_PORT}/{PREDIC
 HDFS_DIR_SESSION_FILTERED = f'hdfs://{MORPHL_SERVER_IP_ADDRESS}:{HDFS_PORT}/{PREDICTION_DAY_AS_STR}_{UNIQUE_HASH}_ga_epnas_filtered'
 HDFS_DIR_HIT_FILTERED = f'hdfs://{MORPHL_SERVER_IP_ADDRESS}:{HDFS_PORT}/{PREDICTION_DAY_AS_STR}_{UNIQUE_HASH}_ga_epnah_filtered'
 HDFS_DIR_STAGES_FILTERED = f'hdfs://{MORPHL_SERVER_IP_ADDRESS}:{HDFS_PORT}/{PREDICTION_DAY_AS_STR}_{UNIQUE_HASH}_ga_epna_shopping_stages_filtered'
+HDFS_DIR_ACTIVE_CLIENT_IDS = f'hdfs://{MORPHL_SERVER_IP_ADDRESS}:{HDFS_PORT}/{PREDICTION_DAY_AS_STR}_{UNIQUE_HASH}_ga_epna_active_client_ids'
+
+SHOPPING_STAGES_COUNT = 6
+
+MODELS_DIR = getenv('MODELS_DIR', '/opt/models')
+MODEL_METADATA_PATH = f'{MODELS_DIR}/ga_epna_model_metadata.json'
+
+# Number of client_id partitions the per user tensors are assembled in.
+TENSOR_PARTITIONS = 32
+
+# Only keep the most recent sessions of every user and the most recent hits
+# of every session, 0 keeps the whole history.
+MAX_SESSIONS_PER_USER = int(getenv('MAX_SESSIONS_PER_USER', '0'))
+MAX_HITS_PER_SESSION = int(getenv('MAX_HITS_PER_SESSION', '0'))
+
+# Keep the encoded sessions in a persistent feature store and only encode the
+# sessions that are new since the previous run.
+INCREMENTAL_FEATURE_STORE = getenv(
+    'INCREMENTAL_FEATURE_STORE', 'false') == 'true'
+
+SESSION_KEY = ['client_id', 'session_id']
+
+# Number of dimensions of each tensor stored as a float32 blob for batch inference.
+TENSOR_DIMENSIONS = {
+    'user_features': 1,
+    'sessions_features': 2,
+    'hits_features': 2,
+    'shopping_stages': 2,
+}
 
 # Initialize the spark sessions and return it.
 
@@ -32,6 +66,9 @@ def get_spark_session():
         .config('spark.cassandra.auth.username', MORPHL_CASSANDRA_USERNAME)
         .config('spark.cassandra.auth.password', MORPHL_CASSANDRA_PASSWORD)
         .config('spark.sql.shuffle.partitions', 16)
+        .config('spark.sql.adaptive.enabled', 'true')
+        .config('spark.sql.adaptive.skewJoin.enabled', 'true')
+        .config('spark.sql.extensions', 'com.datastax.spark.connector.CassandraSparkExtensions')
         .config('parquet.enable.summary-metadata', 'true')
         .getOrCreate())
 
@@ -41,167 +78,228 @@ def get_spark_session():
     return spark_session
 
 
-def calculate_browser_device_features(users_df, sessions_df):
+# Return a spark dataframe from a specified Cassandra table.
+def fetch_from_cassandra(c_table_name, spark_session):
 
-    # Merge sessions and users dataframes.
-    users_sessions_df = (users_df
-                         .join(
-                             sessions_df,
-                             'client_id',
-                             'inner'))
-
-    # Cache df since it will be used to later.
-    users_sessions_df.cache()
-
-    # Aggregate transactions and revenue by mobile device branding.
-    transactions_by_device_df = (users_sessions_df
-                                 .groupBy('mobile_device_branding')
-                                 .agg(
-                                     f.sum('transactions').alias(
-                                         'transactions'),
-                                     f.sum('transaction_revenue').alias(
-                                         'transaction_revenue'),
-                                     f.countDistinct(
-                                         'client_id').alias('users')
-                                 ))
+    load_options = {
+        'keyspace': MORPHL_CASSANDRA_KEYSPACE,
+        'table': c_table_name,
+        'spark.cassandra.input.fetch.size_in_rows': '150'}
+
+    df = (spark_session.read.format('org.apache.spark.sql.cassandra')
+          .options(**load_options)
+          .load())
+
+    return df
+
+
+def calculate_browser_device_features(users_df, sessions_df, spark_session):
+
+    # Merge sessions and users dataframes, heavy users have many sessions
+    # so their rows are spread over several tasks.
+    users_sessions_df = skew_aware_join(
+        sessions_df, users_df, 'client_id', 'inner',
+        get_skewed_keys(sessions_df, 'client_id', 'sessions'))
+
+    users_sessions_df.createOrReplaceTempView('users_sessions')
+
+    # Aggregate transactions and revenue by mobile device branding and by browser
+    # in a single pass. GROUPING(browser) is 1 for the mobile device branding rows.
+    transactions_by_group_df = spark_session.sql(
+        """
+        SELECT mobile_device_branding,
+               browser,
+               GROUPING(browser) AS is_device_group,
+               SUM(transactions) AS transactions,
+               SUM(transaction_revenue) AS transaction_revenue,
+               COUNT(DISTINCT client_id) AS users
+        FROM users_sessions
+        GROUP BY GROUPING SETS ((mobile_device_branding), (browser))
+        """
+    )
+
+    # Cache df since it is tiny and both aggregates are read from it.
+    transactions_by_group_df.cache()
 
     # Calculate device revenue per transaction and device transactions per user columns.
-    transactions_by_device_df = (transactions_by_device_df
-                                 .withColumn(
-                                     'device_revenue_per_transaction',
-                                     transactions_by_device_df.transaction_revenue /
-                                     (transactions_by_device_df.transactions + 1e-5)
-                                 )
-                                 .withColumn(
-                                     'device_transactions_per_user',
-                                     transactions_by_device_df.transactions / transactions_by_device_df.users
-                                 )
-                                 .drop('transactions', 'transaction_revenue')
-                                 )
-
-    # Aggregate transactions and revenue by browser.
-    transactions_by_browser_df = (users_sessions_df
-                                  .groupBy('browser')
-                                  .agg(
-                                      f.sum('transactions').alias(
-                                          'transactions'),
-                                      f.sum('transaction_revenue').alias(
-                                          'transaction_revenue'),
-                                      f.countDistinct(
-                                          'client_id').alias('users')
-                                  ))
+    transactions_by_device_df = (transactions_by_group_df
+                                 .where(f.col('is_device_group') == 1)
+                                 .select(
+                                     'mobile_device_branding',
+                                     (f.col('transaction_revenue') /
+                                      (f.col('transactions') + 1e-5)).alias(
+                                         'device_revenue_per_transaction'),
+                                     (f.col('transactions') / f.col('users')).alias(
+                                         'device_transactions_per_user')
+                                 ))
 
     # Calculate browser revenue per transaction and browser transactions per user columns.
-    transactions_by_browser_df = (transactions_by_browser_df
-                                  .withColumn(
-                                      'browser_revenue_per_transaction',
-                                      transactions_by_browser_df.transaction_revenue /
-                                      (transactions_by_browser_df.transactions + 1e-5)
-                                  )
-                                  .withColumn(
-                                      'browser_transactions_per_user',
-                                      transactions_by_browser_df.transactions / transactions_by_browser_df.users
-                                  )
-                                  .drop('transactions', 'transaction_revenue')
-                                  )
+    transactions_by_browser_df = (transactions_by_group_df
+                                  .where(f.col('is_device_group') == 0)
+                                  .select(
+                                      'browser',
+                                      (f.col('transaction_revenue') /
+                                       (f.col('transactions') + 1e-5)).alias(
+                                          'browser_revenue_per_transaction'),
+                                      (f.col('transactions') / f.col('users')).alias(
+                                          'browser_transactions_per_user')
+                                  ))
 
-    # Merge new columns into main df and return them
+    # Merge new columns into main df and return them, the aggregates
+    # have one row per device or browser so they are broadcast.
     return (users_df
             .join(
-                transactions_by_device_df,
+                f.broadcast(transactions_by_device_df),
                 'mobile_device_branding',
                 'inner'
             )
             .join(
-                transactions_by_browser_df,
+                f.broadcast(transactions_by_browser_df),
                 'browser',
                 'inner')
-            ).repartition(32)
+            )
 
 
-# Sets values outside of [0.0, 1.0] to 0.0 or 1.0.
-def clip(value):
-    if value < 0.0:
-        return 0.0
-    if value > 1.0:
-        return 1.0
+# Load the min and max values used when training the deployed model for each feature.
+def load_scaling_constants():
+    with open(MODEL_METADATA_PATH) as metadata_file:
+        return json.load(metadata_file)['scaling']
 
-    return value
 
+# Normalizes a feature column with the training min and max and
+# sets values outside of [0.0, 1.0] to 0.0 or 1.0.
+def min_max(column_name, feature_scaling):
+    min = feature_scaling[column_name]['min']
+    max = feature_scaling[column_name]['max']
 
-# Normalizes hit data.
-def min_max_hits(hit_features):
-    # Max and min used when training for each feature
-    # ['time_on_page', 'product_detail_views', 'cart_to_detail_rate', 'item_quantity', 'item_revenue',
-    #  'product_adds_to_cart', 'product_checkouts', 'quantity_added_to_cart'
-    # ]
-    min = [0.0] * 8
-    max = [1451.0, 2.0, 100.0, 1.0, 482.0, 1.0, 1.0, 1.0]
+    return f.least(
+        f.greatest((f.col(column_name) - min) / (max - min), f.lit(0.0)),
+        f.lit(1.0)
+    )
 
-    for i in range(0, 8):
-        hit_features[i] = clip((hit_features[i] - min[i]) / (max[i] - min[i]))
 
-    return hit_features
+# Collect the values of a column into a list sorted by another column. Each group's
+# list is built once by sorting the collected (order, value) structs, null values are skipped.
+def collect_ordered_list(order_col, value_col):
+    return f.sort_array(f.collect_list(
+        f.when(f.col(value_col).isNotNull(), f.struct(order_col, value_col)))).getField(value_col)
 
-# Normalizes session data.
 
+# Union dfs that have different columns, the columns a df does not have are null.
+def union_with_nulls(dfs):
+    column_types = {}
+    for df in dfs:
+        for field in df.schema.fields:
+            column_types.setdefault(field.name, field.dataType)
 
-def min_max_sessions(session_features):
-    # Max and min used when training for each feature.
-    # ['session_duration', 'unique_pageviews', 'transactions', 'revenue', 'unique_purchases', 'days_since_last_session',
-    #   'search_result_views', 'search_uniques', 'search_depth', 'search_refinements'
-    # ]
-    min = [8.0, 1.0] + [0.0] * 8
-    max = [11196.0, 115.0, 1.0, 4477.0, 5.0, 149.0, 40.0, 22.0, 118.0, 25.0]
+    return reduce(DataFrame.union, [
+        df.select(*[f.col(name) if name in df.columns else f.lit(None).cast(data_type).alias(name)
+                    for name, data_type in column_types.items()])
+        for df in dfs])
 
-    for i in range(0, 10):
-        session_features[i] = clip(
-            (session_features[i] - min[i]) / (max[i] - min[i]))
 
-    return session_features
+# Keep the max_rows most recent rows of every group and print how many groups were truncated.
+def bound_history(df, group_columns, order_column, max_rows, name):
+    if max_rows <= 0:
+        return df
 
-# Normalizes user data.
+    history_window = Window.partitionBy(
+        *group_columns).orderBy(f.desc(order_column))
 
+    ranked_df = df.withColumn(
+        'history_rank', f.row_number().over(history_window))
 
-def min_max_users(users_features):
-    # Max and min values used when training for each feature.
-    # [ 'session_count', 'device_transactions_per_user', 'device_revenue_per_transaction', 'browser_transactions_per_user',
-    # 'browser_revenue_per_transaction'
-    # ]
-    min = [1.0, 0.007, 225.0, 0.015, 1540.256]
-    max = [6305, 0.048, 2432.607, 0.061, 4209.32]
+    truncated = (ranked_df
+                 .where(f.col('history_rank') > max_rows)
+                 .agg(
+                     f.countDistinct(*group_columns).alias('groups'),
+                     f.count(f.lit(1)).alias('rows')
+                 )
+                 .first())
 
-    for i in range(0, 5):
-        users_features[i] = clip(
-            (users_features[i] - min[i]) / (max[i] - min[i]))
+    print('Bounded %s history to %d: %d groups truncated, %d rows dropped' %
+          (name, max_rows, truncated.groups, truncated.rows))
 
-    return users_features
+    return ranked_df.where(f.col('history_rank') <= max_rows).drop('history_rank')
 
-def pad_with_zero(hits_features):
-    max_hit_count = 0
-    for session in hits_features:
-        max_hit_count = max_hit_count if len(session) < max_hit_count else len(session)
 
-    for session_count in range(len(hits_features)):
-        hits_features[session_count] = hits_features[session_count] + \
-            [[0.0] * 8] * \
-            (max_hit_count - len(hits_features[session_count]))
+# Print how many groups were truncated from the rows kept and the rows
+# there were before the history was bounded in every group.
+def report_truncation(df, kept_column, total_column, max_rows, name):
+    if max_rows <= 0:
+        return
 
-    return hits_features
+    truncated = (df
+                 .where(f.col(total_column) > f.col(kept_column))
+                 .agg(
+                     f.count(f.lit(1)).alias('groups'),
+                     f.sum(f.col(total_column) - f.col(kept_column)).alias('rows')
+                 )
+                 .first())
 
+    print('Bounded %s history to %d: %d groups truncated, %d rows dropped' %
+          (name, max_rows, truncated.groups, truncated.rows or 0))
 
-# Save array data to Cassandra.
 
+# Convert a batch of float arrays to little endian float32 bytes.
+def to_float32_bytes(arrays):
+    return arrays.apply(lambda array: np.asarray(array, dtype='<f4').tobytes())
 
-def save_data(hits_data, hits_num_data, session_data, user_data, shopping_stages_data):
 
-    ga_epna_batch_inference_data = (hits_data
-                                    .join(hits_num_data, 'client_id', 'inner')
-                                    .join(session_data, 'client_id', 'inner')
-                                    .join(user_data, 'client_id', 'inner')
-                                    .join(shopping_stages_data, 'client_id', 'inner')
-                                    .repartition(32)
-                                    )
+# Return the shape of a 1D or 2D array column.
+def tensor_shape(column_name, dimensions):
+    if dimensions == 1:
+        return f.array(f.size(column_name))
+
+    return f.array(f.size(column_name), f.size(f.col(column_name)[0]))
+
+
+# Append newly encoded sessions to the feature store. Rows expire once their
+# sessions have been out of the prediction window for as long as the window lasts,
+# reads also drop the sessions that are no longer in the window before that.
+def save_to_feature_store(session_records, spark_session):
+
+    ga_config_df = (
+        fetch_from_cassandra('ga_epna_config_parameters', spark_session)
+        .filter("morphl_component_name = 'ga_epna' AND parameter_name = 'days_prediction_interval'"))
+
+    days_prediction_interval = int(ga_config_df.first().parameter_value)
+
+    save_options_ga_epna_sessions_feature_store = {
+        'keyspace': MORPHL_CASSANDRA_KEYSPACE,
+        'table': ('ga_epna_sessions_feature_store'),
+        'spark.cassandra.output.ttl': str(days_prediction_interval * 24 * 3600)
+    }
+
+    (session_records
+        .write
+        .format('org.apache.spark.sql.cassandra')
+        .mode('append')
+        .options(**save_options_ga_epna_sessions_feature_store)
+        .save())
+
+
+# Save the new sessions to the feature store and return all the stored sessions,
+# still in the prediction window, of the users that have new sessions.
+def update_feature_store(new_session_records, new_session_keys, window_session_keys, spark_session):
+
+    save_to_feature_store(new_session_records, spark_session)
+
+    active_users = new_session_keys.select('client_id').distinct()
+
+    # The store is partitioned by client_id, so the join with the active users
+    # only reads their partitions when the connector can push it down.
+    return (fetch_from_cassandra('ga_epna_sessions_feature_store', spark_session)
+            .join(active_users, 'client_id', 'inner')
+            .join(window_session_keys, SESSION_KEY, 'left_semi')
+            .select(new_session_records.columns)
+            .repartition(TENSOR_PARTITIONS, 'client_id'))
+
+
+# Save array data to Cassandra.
+
+
+def save_data(ga_epna_batch_inference_data):
 
     save_options_ga_epna_batch_inference_data = {
         'keyspace': MORPHL_CASSANDRA_KEYSPACE,
@@ -237,82 +335,77 @@ def main():
 
     # Calculate revenue by device and revenue by browser columns
     users_df = calculate_browser_device_features(
-        ga_epnau_features_filtered_df, ga_epnas_features_filtered_df)
-
-    # Initialize udfs
-    min_maxer_hits = f.udf(min_max_hits, ArrayType(DoubleType()))
-    min_maxer_sessions = f.udf(min_max_sessions, ArrayType(DoubleType()))
-    min_maxer_users = f.udf(min_max_users, ArrayType(DoubleType()))
-    zero_padder = f.udf(pad_with_zero, ArrayType(
-        ArrayType(ArrayType(DoubleType()))))
-
-    # Initialize windows used for future grouping of data while keeping order.
-    hits_window_by_sessions = Window.partitionBy(
-        'session_id').orderBy('date_hour_minute')
-    hits_window_by_user = Window.partitionBy('client_id').orderBy('session_id')
-
-    # Grab the hit features into an array column 'hits_features',
-    # apply the normalizer to that column,
-    # collect the the hits_features arrays into a list over the window paritioned by session_id,
-    # group the data by session id and get the client_id and last collected list with all the data.
-    # collect all the session lists with hit lists inside over the window partitioned by client_id,
-    # group data by client id and get the client_id and last collected list.
-    # Add the session counts and hit counts then pad the hits with zero according to the max hit count
-    # of users with that session count.
-    #
-    # user[
-    #     session[
-    #         hit[1.0, 2.0, 3.0, 4.0, 0.5, 0.6, 0.7, 0.8],
-    #         hit[5.0, 6.0, 7.0, 8.0, 0.9, 0.1, 0.2, 0.3]
-    #     ],
-    #     session[
-    #         hit[9.0, 10.0, 11.0, 12.0, 13.0, 14.0, 15.0, 16.0],
-    #         hit[0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
-    #     ]
-    # ]
-    ga_epna_data_hits = (ga_epnah_features_filtered_df
+        ga_epnau_features_filtered_df, ga_epnas_features_filtered_df, spark_session)
+
+    # Scaling constants of the deployed model.
+    scaling = load_scaling_constants()
+
+    # Only the tensors of the users active on the prediction day are built,
+    # the device and browser features above still use all users. The active
+    # ids are computed by the filtering preprocessor.
+    active_client_ids = spark_session.read.parquet(HDFS_DIR_ACTIVE_CLIENT_IDS)
+    active_client_ids.cache()
+
+    hits_df = ga_epnah_features_filtered_df.join(
+        active_client_ids, 'client_id', 'left_semi')
+    sessions_df = ga_epnas_features_filtered_df.join(
+        active_client_ids, 'client_id', 'left_semi')
+    shopping_stages_df = ga_epna_shopping_stages_filtered_df.join(
+        active_client_ids, 'client_id', 'left_semi')
+
+    # Keys of the active users' sessions in the prediction window.
+    window_session_keys = sessions_df.select(SESSION_KEY)
+
+    # With the feature store only the sessions it does not have yet are encoded.
+    # The new session keys are checkpointed so they are not computed again
+    # against the store once the new sessions have been saved to it.
+    if INCREMENTAL_FEATURE_STORE:
+        feature_store_keys = fetch_from_cassandra(
+            'ga_epna_sessions_feature_store', spark_session).select(SESSION_KEY)
+
+        new_session_keys = (window_session_keys
+                            .join(feature_store_keys, SESSION_KEY, 'left_anti')
+                            .localCheckpoint())
+
+        # The new sessions are a day or so of sessions, broadcasting their keys
+        # drops the old sessions before the shuffle below without one of its own.
+        hits_df = hits_df.join(
+            f.broadcast(new_session_keys), SESSION_KEY, 'left_semi')
+        sessions_df = sessions_df.join(
+            f.broadcast(new_session_keys), SESSION_KEY, 'left_semi')
+        shopping_stages_df = shopping_stages_df.join(
+            f.broadcast(new_session_keys), SESSION_KEY, 'left_semi')
+
+    # The hits, sessions and stages are put in one df that is partitioned by client_id
+    # once. They are put together by grouping on the session key instead of joining on it,
+    # before Spark 3.3 joins need a partitioning on both key columns and would shuffle
+    # them again. The per session and per user groupings, windows and the join with the
+    # user features only need rows clustered by client_id, so they all reuse this
+    # partitioning and each user's data meets in the same task without more shuffles.
+
+    # Normalize the hit features and grab them into an array column 'hits_features'.
+    ga_epna_data_hits = (hits_df
                          .select(
                              'client_id',
                              'session_id',
                              'date_hour_minute',
                              f.array(
-                                 f.col('time_on_page'),
-                                 f.col('product_detail_views'),
-                                 f.col('cart_to_detail_rate'),
-                                 f.col('item_quantity'),
-                                 f.col('item_revenue'),
-                                 f.col('product_adds_to_cart'),
-                                 f.col('product_checkouts'),
-                                 f.col('quantity_added_to_cart')
+                                 min_max('time_on_page', scaling['hits']),
+                                 min_max('product_detail_views', scaling['hits']),
+                                 min_max('cart_to_detail_rate', scaling['hits']),
+                                 min_max('item_quantity', scaling['hits']),
+                                 min_max('item_revenue', scaling['hits']),
+                                 min_max('product_adds_to_cart', scaling['hits']),
+                                 min_max('product_checkouts', scaling['hits']),
+                                 min_max('quantity_added_to_cart', scaling['hits'])
                              ).alias('hits_features')
-                         ).
-                         withColumn('hits_features', min_maxer_hits('hits_features')).
-                         withColumn('hits_features', f.collect_list('hits_features').over(hits_window_by_sessions)).
-                         groupBy('session_id').agg(
-                             f.last('hits_features').alias('hits_features'),
-                             f.first('client_id').alias('client_id')
-                         ).
-                         withColumn('hits_features', f.collect_list(
-                             'hits_features').over(hits_window_by_user))
-                         .groupBy('client_id').agg(
-                             f.last('hits_features').alias('hits_features')
-                         ).
-                         withColumn('hits_features',
-                                    zero_padder('hits_features'))
-                         .repartition(32)
+                         )
                          )
 
-    # Get session arrays. Similiar process to hits but data is collect at session level
-    # and we also one hot encode categorical data.
+    # Get normalized session arrays, we also one hot encode categorical data.
     #
-    # user[
-    #     session[1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 11.0, 12.0],
-    #     session[13.0, 14.0, 15.0, 16.0, 17.0, 18.0, 19.0, 20.0, 21.0, 22.0, 23.0, 24.0]
-    # ]
-    sessions_window_by_user = Window.partitionBy(
-        'client_id').orderBy('session_id')
-
-    ga_epna_data_sessions = (ga_epnas_features_filtered_df
+    # session[1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0, 11.0, 12.0]
+    ga_epna_data_sessions = (sessions_df
                              .withColumn(
                                  'with_site_search',
                                  f.when(f.col('search_used') == 'Visits With Site Search', 1.0).otherwise(
@@ -333,31 +426,40 @@ def main():
                                  'client_id',
                                  'session_id',
                                  f.array(
-                                     f.col('session_duration'),
-                                     f.col('unique_page_views'),
-                                     f.col('transactions'),
-                                     f.col('transaction_revenue'),
-                                     f.col('unique_purchases'),
-                                     f.col('days_since_last_session'),
-                                     f.col('search_result_views'),
-                                     f.col('search_uniques'),
-                                     f.col('search_depth'),
-                                     f.col('search_refinements'),
+                                     min_max('session_duration', scaling['sessions']),
+                                     min_max('unique_page_views', scaling['sessions']),
+                                     min_max('transactions', scaling['sessions']),
+                                     min_max('transaction_revenue', scaling['sessions']),
+                                     min_max('unique_purchases', scaling['sessions']),
+                                     min_max('days_since_last_session', scaling['sessions']),
+                                     min_max('search_result_views', scaling['sessions']),
+                                     min_max('search_uniques', scaling['sessions']),
+                                     min_max('search_depth', scaling['sessions']),
+                                     min_max('search_refinements', scaling['sessions']),
                                      f.col('with_site_search'),
                                      f.col('without_site_search'),
                                      f.col('new_visitor'),
                                      f.col('returning_visitor'),
                                  ).alias('sessions_features')
                              )
-                             .withColumn('sessions_features', min_maxer_sessions('sessions_features'))
-                             .withColumn('sessions_features', f.collect_list('sessions_features').over(sessions_window_by_user))
-                             .groupBy('client_id')
-                             .agg(f.last('sessions_features').alias('sessions_features')
-                                  )
-                             .repartition(32)
                              )
 
-    # Get user arrays. Similar to sessions with data at user level.
+    # Get the shopping stages arrays. The filtering stage stores each
+    # session's shopping stage as its index in the model's one hot encoding.
+    #
+    # session[stages]
+    ga_epna_data_shopping_stages = (shopping_stages_df.
+                                    select(
+                                        'client_id',
+                                        'session_id',
+                                        f.array(
+                                            *[(f.col('shopping_stage') == i).cast('double')
+                                              for i in range(SHOPPING_STAGES_COUNT)]
+                                        ).alias('shopping_stage')
+                                    )
+                                    )
+
+    # Get normalized user arrays. Similar to sessions with data at user level.
     # user[1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0]
     ga_epna_data_users = (users_df.
                           withColumn(
@@ -375,102 +477,172 @@ def main():
                           select(
                               'client_id',
                               f.array(
-                                  f.col('session_count'),
-                                  f.col('device_transactions_per_user'),
-                                  f.col('device_revenue_per_transaction'),
-                                  f.col('browser_transactions_per_user'),
-                                  f.col('browser_revenue_per_transaction'),
+                                  min_max('session_count', scaling['users']),
+                                  min_max('device_transactions_per_user', scaling['users']),
+                                  min_max('device_revenue_per_transaction', scaling['users']),
+                                  min_max('browser_transactions_per_user', scaling['users']),
+                                  min_max('browser_revenue_per_transaction', scaling['users']),
                                   f.col('is_desktop'),
                                   f.col('is_mobile'),
                                   f.col('is_tablet'),
                               ).alias('user_features')
                           )
-                          .withColumn('user_features', min_maxer_users('user_features'))
-                          .repartition(32)
+                          .repartition(TENSOR_PARTITIONS, 'client_id')
                           )
 
-    # Get the shopping stages arrays
-    # user[
-    #       session[stages],
-    #       session[stages]
-    # ]
+    ga_epna_data_session_parts = (union_with_nulls([
+                                      ga_epna_data_hits,
+                                      ga_epna_data_sessions,
+                                      ga_epna_data_shopping_stages
+                                  ])
+                                  .repartition(TENSOR_PARTITIONS, 'client_id')
+                                  )
 
-    stages_window_by_users = Window.partitionBy(
-        'client_id').orderBy('session_id')
-
-    ga_epna_data_shopping_stages = (ga_epna_shopping_stages_filtered_df.
-                                    withColumn(
-                                        'shopping_stage_1', f.when(
-                                            f.col('shopping_stage') == 'ALL_VISITS', 1.0).otherwise(0.0)
-                                    ).
-                                    withColumn(
-                                        'shopping_stage_2', f.when(
-                                            f.col('shopping_stage') == 'ALL_VISITS|PRODUCT_VIEW', 1.0).otherwise(0.0)
-                                    ).
-                                    withColumn(
-                                        'shopping_stage_3', f.when(
-                                            f.col('shopping_stage') == 'ADD_TO_CART|ALL_VISITS|PRODUCT_VIEW', 1.0).otherwise(0.0)
-                                    ).
-                                    withColumn(
-                                        'shopping_stage_4', f.when(
-                                            f.col('shopping_stage') == 'ADD_TO_CART|ALL_VISITS|CHECKOUT|PRODUCT_VIEW', 1.0).otherwise(0.0)
-                                    ).
-                                    withColumn(
-                                        'shopping_stage_5', f.when(
-                                            f.col('shopping_stage') == 'ALL_VISITS|CHECKOUT|PRODUCT_VIEW', 1.0).otherwise(0.0)
-                                    ).
-                                    withColumn('shopping_stage_6', f.when(
-                                        f.col('shopping_stage') == 'TRANSACTION', 1.0).otherwise(0.0)
+    # Bound the hits of a session before they are collected. Only the hits have a
+    # date_hour_minute, the session and stage rows rank after them.
+    if MAX_HITS_PER_SESSION > 0:
+        hits_window = Window.partitionBy(
+            *SESSION_KEY).orderBy(f.desc('date_hour_minute'))
+
+        ga_epna_data_session_parts = (ga_epna_data_session_parts
+                                      .withColumn('history_rank', f.row_number().over(hits_window))
+                                      .withColumn(
+                                          'hits_features',
+                                          f.when(f.col('history_rank') <= MAX_HITS_PER_SESSION,
+                                                 f.col('hits_features'))
+                                      ))
+
+    # Put together everything we know about a session, the hits_features arrays
+    # are collected ordered by date_hour_minute. Like with inner joins, only the
+    # sessions that have hits, session features and a shopping stage are kept.
+    # The hits the session had before it was bounded are counted in hits_total.
+    #
+    # session[
+    #     hit[1.0, 2.0, 3.0, 4.0, 0.5, 0.6, 0.7, 0.8],
+    #     hit[5.0, 6.0, 7.0, 8.0, 0.9, 0.1, 0.2, 0.3]
+    # ]
+    ga_epna_data_session_records = (ga_epna_data_session_parts
+                                    .groupBy(*SESSION_KEY)
+                                    .agg(
+                                        collect_ordered_list('date_hour_minute', 'hits_features').alias(
+                                            'hits_features'),
+                                        f.count('date_hour_minute').alias('hits_total'),
+                                        f.first('sessions_features', ignorenulls=True).alias(
+                                            'sessions_features'),
+                                        f.first('shopping_stage', ignorenulls=True).alias(
+                                            'shopping_stage')
+                                    )
+                                    .where(
+                                        (f.size('hits_features') > 0) &
+                                        f.col('sessions_features').isNotNull() &
+                                        f.col('shopping_stage').isNotNull()
                                     )
+                                    )
+
+    ga_epna_data_session_records = (ga_epna_data_session_records
                                     .select(
                                         'client_id',
                                         'session_id',
-                                        f.array(
-                                            f.col('shopping_stage_2'),
-                                            f.col('shopping_stage_1'),
-                                            f.col('shopping_stage_3'),
-                                            f.col('shopping_stage_6'),
-                                            f.col('shopping_stage_4'),
-                                            f.col('shopping_stage_5'),
-                                        ).alias('shopping_stage')
-                                    ).
-                                    withColumn('shopping_stage', f.collect_list('shopping_stage').over(stages_window_by_users)).
-                                    groupBy('client_id').
-                                    agg(
-                                        f.last('shopping_stage').alias(
-                                            'shopping_stages')
-                                    ).
-                                    repartition(32)
+                                        'hits_features',
+                                        f.size('hits_features').alias('hits_count'),
+                                        'hits_total',
+                                        'sessions_features',
+                                        'shopping_stage'
+                                    )
                                     )
 
-    # Get the number of hits arrays
+    # The session records are cached while the truncation reports read them, so
+    # the hits are only shuffled and collected once. With the feature store the
+    # sessions bound applies to the stored sessions, which are cached below.
+    cached_session_records = [ga_epna_data_session_records]
+
+    if MAX_HITS_PER_SESSION > 0 or (MAX_SESSIONS_PER_USER > 0 and not INCREMENTAL_FEATURE_STORE):
+        ga_epna_data_session_records.cache()
+
+    report_truncation(ga_epna_data_session_records, 'hits_count',
+                      'hits_total', MAX_HITS_PER_SESSION, 'session hits')
+
+    ga_epna_data_session_records = ga_epna_data_session_records.drop('hits_total')
+
+    if INCREMENTAL_FEATURE_STORE:
+        ga_epna_data_session_records = update_feature_store(
+            ga_epna_data_session_records, new_session_keys, window_session_keys, spark_session)
+
+        # Cached so the store is only read once by the sessions bound.
+        if MAX_SESSIONS_PER_USER > 0:
+            ga_epna_data_session_records.cache()
+            cached_session_records.append(ga_epna_data_session_records)
+
+    # Bound the sessions of a user before they are collected.
+    ga_epna_data_session_records = bound_history(
+        ga_epna_data_session_records,
+        ['client_id'],
+        'session_id',
+        MAX_SESSIONS_PER_USER,
+        'user sessions'
+    )
+
+    # Group each user's sessions ordered by session_id and add the user features. The session
+    # level lists are pulled out of the sorted sessions, so the hits, hit counts,
+    # sessions and stages of a user always line up. The hits of all sessions are
+    # stored one after the other, the session hit counts give the offsets
+    # of each session's hits and padding only happens at inference time.
+    #
     # user[
-    #     numHitsSession1,
-    #     numHitsSession2,
-    #     numHitsSession3
+    #     hit[1.0, 2.0, 3.0, 4.0, 0.5, 0.6, 0.7, 0.8] (session 1)
+    #     hit[5.0, 6.0, 7.0, 8.0, 0.9, 0.1, 0.2, 0.3] (session 1)
+    #     hit[9.0, 10.0, 11.0, 12.0, 13.0, 14.0, 15.0, 16.0] (session 2)
     # ]
+    #
+    # Every tensor is then stored as a float32 binary blob of its flattened values,
+    # with its shape in tensor_shapes, so inference can read it straight into numpy.
+    float32_bytes = f.pandas_udf(to_float32_bytes, BinaryType())
+
+    ga_epna_batch_inference_data = (ga_epna_data_session_records
+                                    .groupBy('client_id')
+                                    .agg(
+                                        f.sort_array(f.collect_list(f.struct(
+                                            'session_id',
+                                            'hits_features',
+                                            'hits_count',
+                                            'sessions_features',
+                                            'shopping_stage'
+                                        ))).alias('sessions')
+                                    )
+                                    .join(ga_epna_data_users, 'client_id', 'inner')
+                                    .select(
+                                        'client_id',
+                                        'user_features',
+                                        f.col('sessions.session_id').alias(
+                                            'session_ids'),
+                                        f.col('sessions.sessions_features').alias(
+                                            'sessions_features'),
+                                        f.flatten(f.col('sessions.hits_features')).alias(
+                                            'hits_features'),
+                                        f.col('sessions.hits_count').alias(
+                                            'sessions_hits_count'),
+                                        f.col('sessions.shopping_stage').alias(
+                                            'shopping_stages')
+                                    )
+                                    .select(
+                                        'client_id',
+                                        'session_ids',
+                                        'sessions_hits_count',
+                                        f.create_map(
+                                            *[column for name, dimensions in TENSOR_DIMENSIONS.items()
+                                              for column in (f.lit(name), tensor_shape(name, dimensions))]
+                                        ).alias('tensor_shapes'),
+                                        *[float32_bytes(
+                                            f.flatten(f.col(name)) if dimensions == 2 else f.col(name)
+                                        ).alias(name)
+                                            for name, dimensions in TENSOR_DIMENSIONS.items()]
+                                    )
+                                    )
 
-    num_hits_window_by_user = Window.partitionBy(
-        'client_id').orderBy('session_id')
-
-    ga_epna_data_num_hits = (ga_epnah_features_filtered_df.
-                             groupBy('session_id').
-                             agg(
-                                 f.first('client_id').alias('client_id'),
-                                 f.count('date_hour_minute').alias(
-                                     'hits_count')
-                             ).
-                             withColumn('sessions_hits_count', f.collect_list('hits_count').over(num_hits_window_by_user)).
-                             groupBy('client_id').
-                             agg(
-                                 f.last('sessions_hits_count').alias(
-                                     'sessions_hits_count')
-                             ).repartition(32)
-                             )
-
-    save_data(ga_epna_data_hits, ga_epna_data_num_hits, ga_epna_data_sessions,
-              ga_epna_data_users, ga_epna_data_shopping_stages)
+    save_data(ga_epna_batch_inference_data)
 
+    for session_records in cached_session_records:
+        session_records.unpersist()
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,7 @@
 cp -r /opt/ga_epna /opt/code
 cd /opt/code
 
-spark-submit --jars /opt/spark/jars/spark-cassandra-connector.jar,/opt/spark/jars/jsr166e.jar /opt/code/pre_processing/calculations_processing/ga_epna_calculations_preprocessor.py
+spark-submit --jars /opt/spark/jars/spark-cassandra-connector.jar,/opt/spark/jars/jsr166e.jar \
+  --py-files /opt/code/pre_processing/ga_epna_skew_join.py \
+  /opt/code/pre_processing/calculations_processing/ga_epna_calculations_preprocessor.py
 
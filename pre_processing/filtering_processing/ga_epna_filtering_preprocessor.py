@@ -1,6 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
 from os import getenv
+from pyspark import StorageLevel
 from pyspark.sql import functions as f, SparkSession
-from pyspark.sql.types import StringType
+
+from ga_epna_skew_join import get_skewed_keys, skew_aware_join
 
 
 HDFS_PORT = 9000
@@ -19,6 +22,11 @@ HDFS_DIR_USER = f'hdfs://{MORPHL_SERVER_IP_ADDRESS}:{HDFS_PORT}/{PREDICTION_DAY_
 HDFS_DIR_SESSION = f'hdfs://{MORPHL_SERVER_IP_ADDRESS}:{HDFS_PORT}/{PREDICTION_DAY_AS_STR}_{UNIQUE_HASH}_ga_epnas_filtered'
 HDFS_DIR_HIT = f'hdfs://{MORPHL_SERVER_IP_ADDRESS}:{HDFS_PORT}/{PREDICTION_DAY_AS_STR}_{UNIQUE_HASH}_ga_epnah_filtered'
 HDFS_DIR_SHOPPING = f'hdfs://{MORPHL_SERVER_IP_ADDRESS}:{HDFS_PORT}/{PREDICTION_DAY_AS_STR}_{UNIQUE_HASH}_ga_epna_shopping_stages_filtered'
+HDFS_DIR_ACTIVE_CLIENT_IDS = f'hdfs://{MORPHL_SERVER_IP_ADDRESS}:{HDFS_PORT}/{PREDICTION_DAY_AS_STR}_{UNIQUE_HASH}_ga_epna_active_client_ids'
+
+# Comma separated list of sinks the filtered data is saved to (hdfs, cassandra).
+FILTERED_DATA_SINKS = getenv(
+    'FILTERED_DATA_SINKS', 'hdfs,cassandra').split(',')
 
 # Initialize the spark sessions and return it.
 
@@ -33,6 +41,8 @@ def get_spark_session():
         .config('spark.cassandra.auth.username', MORPHL_CASSANDRA_USERNAME)
         .config('spark.cassandra.auth.password', MORPHL_CASSANDRA_PASSWORD)
         .config('spark.sql.shuffle.partitions', 16)
+        .config('spark.sql.adaptive.enabled', 'true')
+        .config('spark.sql.adaptive.skewJoin.enabled', 'true')
         .config('parquet.enable.summary-metadata', 'true')
         .getOrCreate())
 
@@ -56,46 +66,115 @@ def fetch_from_cassandra(c_table_name, spark_session):
     return df
 
 
-# Formats the stages column so that
-# we keep relevant stages and give them a standard format for one hot encoding.
-def format_and_filter_shopping_stages(stages):
+# Bit assigned to every shopping stage we ingest, a session's set of stages
+# is encoded as the bitwise OR of its stages' bits.
+SHOPPING_STAGE_BITS = {
+    'ALL_VISITS': 1,
+    'PRODUCT_VIEW': 2,
+    'ADD_TO_CART': 4,
+    'CHECKOUT': 8,
+    'TRANSACTION': 16,
+}
+
+TRANSACTION_BIT = SHOPPING_STAGE_BITS['TRANSACTION']
+
+# Any other stage makes the combination irrelevant for the model.
+OTHER_STAGE_BIT = 32
+
+# Position of each relevant stage combination in the model's one hot encoding:
+# [ALL_VISITS|PRODUCT_VIEW, ALL_VISITS, ADD_TO_CART|ALL_VISITS|PRODUCT_VIEW, TRANSACTION,
+#  ADD_TO_CART|ALL_VISITS|CHECKOUT|PRODUCT_VIEW, ALL_VISITS|CHECKOUT|PRODUCT_VIEW]
+# Lonely product views count as 'ALL_VISITS|PRODUCT_VIEW', any set containing a
+# transaction counts as 'TRANSACTION' and every other combination as 'ALL_VISITS'.
+SHOPPING_STAGE_MASK_TO_INDEX = {
+    2: 0,
+    3: 0,
+    1: 1,
+    7: 2,
+    15: 4,
+    11: 5,
+}
 
-    # Relevant stages for the current model.
-    stages_to_keep = ['ALL_VISITS', 'ALL_VISITS|PRODUCT_VIEW', 'ADD_TO_CART|ALL_VISITS|PRODUCT_VIEW',
-                      'ADD_TO_CART|ALL_VISITS|CHECKOUT|PRODUCT_VIEW', 'ALL_VISITS|CHECKOUT|PRODUCT_VIEW', 'TRANSACTION']
+ALL_VISITS_INDEX = 1
+TRANSACTION_INDEX = 3
 
-    # Sort the stages because the stages set does not always have the same order.
-    stages.sort()
 
-    # Break up the stages array into a string with the format "stage1|stage2|stage3".
-    stages = '|'.join(stages)
+# Formats the stages column so that we keep relevant stages and replace
+# them with their position in the model's one hot encoding.
+def format_and_filter_shopping_stages(stages_mask):
 
-    # Replace all stages that have a transaction with the 'TRANSACTION' strings.
-    stages = 'TRANSACTION' if stages.find('TRANSACTION') != -1 else stages
+    stage_indexes = f.create_map(
+        *[f.lit(v) for item in SHOPPING_STAGE_MASK_TO_INDEX.items() for v in item])
 
-    # Replace lonely product views with 'ALL_VISITS|PRODUCT_VIEW'.
-    stages = stages if stages != 'PRODUCT_VIEW' else 'ALL_VISITS|PRODUCT_VIEW'
+    return (f.when(stages_mask.bitwiseAND(TRANSACTION_BIT) != 0, TRANSACTION_INDEX)
+            .otherwise(f.coalesce(stage_indexes[stages_mask], f.lit(ALL_VISITS_INDEX))))
 
-    # All stages that are not part of the list we need for the model,
-    # will be replaced with 'ALL_VISITS'.
-    stages = stages if stages in stages_to_keep else 'ALL_VISITS'
 
-    return stages
+# Return the ids of the users that have data on the prediction day, batch
+# inference only makes predictions for them. They are computed once here and
+# saved for the calculations preprocessor.
+def get_active_client_ids(users_df):
+    return (users_df
+            .where(f.col('day_of_data_capture') == PREDICTION_DAY_AS_STR)
+            .select('client_id')
+            .distinct())
 
 
 # Filters the data and makes sure that the client_ids we make predictions on
 # have data in all relevant tables.
 def filter_data(users_df, mobile_brand_df, sessions_df, shopping_stages_df, hits_df, product_info_df, session_index_df):
 
+    hit_key = ['client_id', 'session_id',
+               'day_of_data_capture', 'date_hour_minute']
+
+    # Users and sessions are kept for everyone since the device and browser
+    # features are aggregated over all users. Hits and shopping stages are only
+    # needed to build the tensors of the active users.
+    active_client_ids = get_active_client_ids(users_df)
+    active_client_ids.cache()
+
+    print('Active users on %s: %d' %
+          (PREDICTION_DAY_AS_STR, active_client_ids.count()))
+
+    # Keys of all the hits, used to find the sessions and users with hit data.
+    hit_keys_df = hits_df.select('client_id', 'session_id')
+
+    hits_df = hits_df.join(active_client_ids, 'client_id', 'left_semi')
+    product_info_df = product_info_df.join(
+        active_client_ids, 'client_id', 'left_semi')
+
+    # Product info has one row per product per minute, so sum the product
+    # metrics per hit to keep the join with hits one to one. The cart to
+    # detail rate is a ratio so it is averaged instead.
+    aggregated_product_info_df = (product_info_df
+                                  .groupBy(hit_key)
+                                  .agg(
+                                      f.sum('product_detail_views').alias(
+                                          'product_detail_views'),
+                                      f.avg('cart_to_detail_rate').alias(
+                                          'cart_to_detail_rate'),
+                                      f.sum('item_quantity').alias(
+                                          'item_quantity'),
+                                      f.sum('item_revenue').alias(
+                                          'item_revenue'),
+                                      f.sum('product_adds_to_cart').alias(
+                                          'product_adds_to_cart'),
+                                      f.sum('product_checkouts').alias(
+                                          'product_checkouts'),
+                                      f.sum('quantity_added_to_cart').alias(
+                                          'quantity_added_to_cart')
+                                  ))
+
+    # The active hits are read once, counted and joined from the cache.
+    hits_df.cache()
+    hits_count_before_join = hits_df.count()
+    active_hits_df = hits_df
+
     # Add product info to hits and replace missing values with 0.0
     hits_df = (hits_df
                .join(
-                   product_info_df.drop('product_name'),
-                   ['client_id',
-                    'session_id',
-                    'day_of_data_capture',
-                    'date_hour_minute'
-                    ],
+                   aggregated_product_info_df,
+                   hit_key,
                    'left_outer'
                )
                .fillna(
@@ -113,6 +192,21 @@ def filter_data(users_df, mobile_brand_df, sessions_df, shopping_stages_df, hits
                .repartition(32)
                )
 
+    # The joined hits are reused by the filters below, counting them fills the cache.
+    hits_df.cache()
+
+    # Report the hit counts around the join so row blow ups are visible.
+    hits_count_after_join = hits_df.count()
+    print('Hits before product info join: %d, after: %d' %
+          (hits_count_before_join, hits_count_after_join))
+
+    active_hits_df.unpersist()
+
+    # The skewed keys of the hits are counted once on the cached hits, the
+    # filters below only remove hits so the keys stay the skewed ones.
+    hits_skewed_session_ids = get_skewed_keys(hits_df, 'session_id', 'hits')
+    hits_skewed_client_ids = get_skewed_keys(hits_df, 'client_id', 'hits')
+
     # Get the number of sessions a user has
     user_session_counts = session_index_df.groupBy(
         'client_id').agg(f.max('session_index').alias('session_count'))
@@ -130,9 +224,14 @@ def filter_data(users_df, mobile_brand_df, sessions_df, shopping_stages_df, hits
                    .repartition(32)
                    )
 
+    # The sessions are read by the skew count and by the filters below.
+    sessions_df.cache()
+    sessions_skewed_client_ids = get_skewed_keys(
+        sessions_df, 'client_id', 'sessions')
+
     # Get the session ids that are present in all tables.
     sessions_df_session_ids = sessions_df.select('session_id').distinct()
-    hits_df_session_ids = hits_df.select('session_id').distinct()
+    hits_df_session_ids = hit_keys_df.select('session_id').distinct()
     shopping_stages_df_session_ids = shopping_stages_df.select(
         'session_id').distinct()
 
@@ -156,11 +255,13 @@ def filter_data(users_df, mobile_brand_df, sessions_df, shopping_stages_df, hits
                                           )
 
     # Only keep hits that we have stage and session data for.
-    hits_filtered_by_session_id_df = (hits_df.
-                                      drop('day_of_data_capture').
-                                      join(complete_session_ids,
-                                           'session_id', 'inner')
-                                      )
+    hits_filtered_by_session_id_df = skew_aware_join(
+        hits_df.drop('day_of_data_capture'),
+        complete_session_ids,
+        'session_id',
+        'inner',
+        hits_skewed_session_ids
+    )
 
     # Only keep shopping stage info that we have hit and session data on.
     shopping_stages_filtered_by_session_id_df = (shopping_stages_df.
@@ -179,8 +280,11 @@ def filter_data(users_df, mobile_brand_df, sessions_df, shopping_stages_df, hits
     client_ids_users = users_df.select('client_id').distinct()
     client_ids_sessions = sessions_filtered_by_session_id_df.select(
         'client_id').distinct()
-    client_ids_hits = hits_filtered_by_session_id_df.select(
-        'client_id').distinct()
+    client_ids_hits = (hit_keys_df
+                       .join(complete_session_ids, 'session_id', 'left_semi')
+                       .select('client_id')
+                       .distinct()
+                       )
 
     # Get client_ids that exist in all dfs.
     complete_client_ids = (client_ids_users
@@ -215,20 +319,24 @@ def filter_data(users_df, mobile_brand_df, sessions_df, shopping_stages_df, hits
     filtered_mobile_brand_df.repartition(32)
 
     # Only keep hits with complete data
-    filtered_hits_df = (hits_filtered_by_session_id_df.
-                        drop('day_of_data_capture').
-                        join(complete_client_ids,
-                             'client_id', 'inner')
-                        )
+    filtered_hits_df = skew_aware_join(
+        hits_filtered_by_session_id_df.drop('day_of_data_capture'),
+        complete_client_ids,
+        'client_id',
+        'inner',
+        hits_skewed_client_ids
+    )
 
     filtered_hits_df.repartition(32)
 
     # Only keep sessions with complete data
-    filtered_sessions_df = (sessions_filtered_by_session_id_df.
-                            drop('day_of_data_capture').
-                            join(complete_client_ids,
-                                 'client_id', 'inner')
-                            )
+    filtered_sessions_df = skew_aware_join(
+        sessions_filtered_by_session_id_df.drop('day_of_data_capture'),
+        complete_client_ids,
+        'client_id',
+        'inner',
+        sessions_skewed_client_ids
+    )
 
     filtered_sessions_df.repartition(32)
 
@@ -268,19 +376,25 @@ def filter_data(users_df, mobile_brand_df, sessions_df, shopping_stages_df, hits
 
     final_users_df.repartition(32)
 
-    shopping_stage_formatter = f.udf(
-        format_and_filter_shopping_stages, StringType())
+    stage_bits = f.create_map(
+        *[f.lit(v) for item in SHOPPING_STAGE_BITS.items() for v in item])
 
-    # Group shopping stages per session into a set.
+    # Encode the shopping stages of each session as a bitmask and map it
+    # to the stage's one hot index.
     final_shopping_stages_df = (shopping_stages_filtered_by_session_id_df.
+                                join(active_client_ids, 'client_id', 'left_semi').
                                 join(complete_client_ids, 'client_id', 'inner').
                                 groupBy('session_id').
                                 agg(f.first('client_id').alias('client_id'),
-                                    f.collect_set('shopping_stage').alias(
-                                    'shopping_stage')
-                                    ).
-                                withColumn('shopping_stage', shopping_stage_formatter(
-                                    'shopping_Stage'))
+                                    f.sumDistinct(
+                                        f.coalesce(
+                                            stage_bits[f.col('shopping_stage')],
+                                            f.lit(OTHER_STAGE_BIT))
+                                ).alias('shopping_stages_mask')
+                                ).
+                                withColumn('shopping_stage', format_and_filter_shopping_stages(
+                                    f.col('shopping_stages_mask'))).
+                                drop('shopping_stages_mask')
                                 )
 
     final_shopping_stages_df.repartition(32)
@@ -290,67 +404,83 @@ def filter_data(users_df, mobile_brand_df, sessions_df, shopping_stages_df, hits
         'session': filtered_sessions_df,
         'hit': filtered_hits_df,
         'shopping_stages': final_shopping_stages_df,
+        'active_client_ids': active_client_ids,
+        # Cached dfs the filtered data is computed from, released once it is saved.
+        'cached': [hits_df, sessions_df, active_client_ids, complete_session_ids, complete_client_ids],
     }
 
 
-def save_filtered_data(user_df, session_df, hit_df, shopping_stage_df):
+# Return a sink that saves a df to HDFS as parquet.
+def hdfs_sink(hdfs_dir):
 
-    # Cache and save data to Hadoop
-    user_df.cache()
-    session_df.cache()
-    hit_df.cache()
-    shopping_stage_df.cache()
+    def save(df):
+        df.write.parquet(hdfs_dir)
 
-    user_df.write.parquet(HDFS_DIR_USER)
-    session_df.write.parquet(HDFS_DIR_SESSION)
-    hit_df.write.parquet(HDFS_DIR_HIT)
-    shopping_stage_df.write.parquet(HDFS_DIR_SHOPPING)
+    return save
 
-    save_options_ga_epnau_features_filtered = {
-        'keyspace': MORPHL_CASSANDRA_KEYSPACE,
-        'table': ('ga_epnau_features_filtered')
-    }
-    save_options_ga_epnas_features_filtered = {
-        'keyspace': MORPHL_CASSANDRA_KEYSPACE,
-        'table': ('ga_epnas_features_filtered')
-    }
-    save_options_ga_epnah_features_filtered = {
-        'keyspace': MORPHL_CASSANDRA_KEYSPACE,
-        'table': ('ga_epnah_features_filtered')
-    }
-    save_options_ga_epna_shopping_stages_filtered = {
+
+# Return a sink that appends a df to a Cassandra table.
+def cassandra_sink(c_table_name):
+
+    save_options = {
         'keyspace': MORPHL_CASSANDRA_KEYSPACE,
-        'table': ('ga_epna_shopping_stages_filtered')
+        'table': c_table_name
     }
 
-    # Save data to Cassandra
-    (user_df
-        .write
-        .format('org.apache.spark.sql.cassandra')
-        .mode('append')
-        .options(**save_options_ga_epnau_features_filtered)
-        .save())
-
-    (session_df
-        .write
-        .format('org.apache.spark.sql.cassandra')
-        .mode('append')
-        .options(**save_options_ga_epnas_features_filtered)
-        .save())
-
-    (hit_df
-        .write
-        .format('org.apache.spark.sql.cassandra')
-        .mode('append')
-        .options(**save_options_ga_epnah_features_filtered)
-        .save())
-
-    (shopping_stage_df
-     .write
-     .format('org.apache.spark.sql.cassandra')
-     .mode('append')
-     .options(**save_options_ga_epna_shopping_stages_filtered)
-     .save())
+    def save(df):
+        (df
+            .write
+            .format('org.apache.spark.sql.cassandra')
+            .mode('append')
+            .options(**save_options)
+            .save())
+
+    return save
+
+
+# Compute the df once and write it to every sink from the cached blocks,
+# then release them.
+def save_to_sinks(df, sinks):
+
+    df.persist(StorageLevel.MEMORY_AND_DISK)
+
+    # Materialise the cache before the writes so they do not race to compute it.
+    df.count()
+
+    # Each sink is a separate Spark job, running them from separate threads
+    # lets the scheduler interleave their tasks.
+    with ThreadPoolExecutor(max_workers=len(sinks)) as executor:
+        for future in [executor.submit(sink, df) for sink in sinks]:
+            future.result()
+
+    df.unpersist()
+
+
+def save_filtered_data(user_df, session_df, hit_df, shopping_stage_df, active_client_ids_df):
+
+    filtered_data = [
+        (user_df, HDFS_DIR_USER, 'ga_epnau_features_filtered'),
+        (session_df, HDFS_DIR_SESSION, 'ga_epnas_features_filtered'),
+        (hit_df, HDFS_DIR_HIT, 'ga_epnah_features_filtered'),
+        (shopping_stage_df, HDFS_DIR_SHOPPING, 'ga_epna_shopping_stages_filtered'),
+    ]
+
+    for df, hdfs_dir, c_table_name in filtered_data:
+        sinks = []
+
+        # HDFS data is read by the calculations preprocessor.
+        if 'hdfs' in FILTERED_DATA_SINKS:
+            sinks.append(hdfs_sink(hdfs_dir))
+
+        if 'cassandra' in FILTERED_DATA_SINKS:
+            sinks.append(cassandra_sink(c_table_name))
+
+        if sinks:
+            save_to_sinks(df, sinks)
+
+    # The active ids are cached by filter_data and only read by the calculations preprocessor.
+    if 'hdfs' in FILTERED_DATA_SINKS:
+        hdfs_sink(HDFS_DIR_ACTIVE_CLIENT_IDS)(active_client_ids_df)
 
 
 def main():
@@ -393,7 +523,11 @@ def main():
     ))
 
     save_filtered_data(
-        filtered_data_dfs['user'], filtered_data_dfs['session'], filtered_data_dfs['hit'], filtered_data_dfs['shopping_stages'])
+        filtered_data_dfs['user'], filtered_data_dfs['session'], filtered_data_dfs['hit'], filtered_data_dfs['shopping_stages'],
+        filtered_data_dfs['active_client_ids'])
+
+    for df in filtered_data_dfs['cached']:
+        df.unpersist()
 
 
 if __name__ == '__main__':
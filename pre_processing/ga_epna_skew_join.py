@@ -0,0 +1,88 @@
+from os import getenv
+from pyspark import __version__ as SPARK_VERSION
+from pyspark.sql import functions as f
+
+
+# A key is skewed if it has SKEW_FACTOR times more rows than the average key.
+SKEW_FACTOR = float(getenv('SKEW_FACTOR', '10'))
+SKEW_SALT_BUCKETS = int(getenv('SKEW_SALT_BUCKETS', '16'))
+SKEW_MAX_KEYS = 1000
+SKEW_REPORT_SIZE = 10
+
+# From Spark 3 the adaptive skew join, enabled by the preprocessors, splits the
+# partitions of skewed keys at run time so the keys are not salted by hand.
+ADAPTIVE_SKEW_JOIN = int(SPARK_VERSION.split('.')[0]) >= 3
+
+
+# Print the row counts of the keys in a skew report.
+def print_key_counts(key_counts, key):
+    for row in key_counts[:SKEW_REPORT_SIZE]:
+        print('    %s: %d rows' % (row[key], row['count']))
+
+
+# Return the keys of a df that have far more rows than the average key and
+# print the most skewed ones. With the adaptive skew join no key is salted,
+# only the keys with the most rows are counted for the report. The df is read
+# by the count, so it should be cached when it is expensive to compute.
+def get_skewed_keys(df, key, name):
+
+    if ADAPTIVE_SKEW_JOIN:
+        top_keys = (df
+                    .groupBy(key)
+                    .count()
+                    .orderBy(f.desc('count'))
+                    .limit(SKEW_REPORT_SIZE)
+                    .collect())
+
+        print('Top %s keys for %s (skewed keys are split by the adaptive skew join):' %
+              (key, name))
+        print_key_counts(top_keys, key)
+
+        return []
+
+    # Cached since the average and the skewed keys are read from it.
+    key_counts = df.groupBy(key).count().cache()
+
+    average_count = key_counts.agg(f.avg('count')).first()[0]
+
+    if average_count is None:
+        key_counts.unpersist()
+        return []
+
+    skewed_keys = (key_counts
+                   .where(f.col('count') > max(average_count * SKEW_FACTOR, SKEW_SALT_BUCKETS))
+                   .orderBy(f.desc('count'))
+                   .limit(SKEW_MAX_KEYS)
+                   .collect())
+
+    key_counts.unpersist()
+
+    print('Top skewed %s keys for %s (average rows per key: %.2f):' %
+          (key, name, average_count))
+    print_key_counts(skewed_keys, key)
+
+    return [row[key] for row in skewed_keys]
+
+
+# Join a large df with a smaller one, spreading the rows of the skewed keys of
+# the large df over several salted keys so they do not all end up in one task.
+def skew_aware_join(large_df, small_df, key, how, skewed_keys):
+
+    if not skewed_keys:
+        return large_df.join(small_df, key, how)
+
+    is_skewed = f.col(key).isin(skewed_keys)
+
+    # Rows of skewed keys get a random salt, the matching rows of the
+    # small df are replicated for every salt value.
+    salted_large_df = large_df.withColumn(
+        'salt',
+        f.when(is_skewed, (f.rand() * SKEW_SALT_BUCKETS).cast('int')).otherwise(0))
+
+    salted_small_df = small_df.withColumn(
+        'salt',
+        f.explode(
+            f.when(is_skewed, f.array(*[f.lit(i) for i in range(SKEW_SALT_BUCKETS)]))
+            .otherwise(f.array(f.lit(0)))))
+
+    return salted_large_df.join(salted_small_df, [key, 'salt'], how).drop('salt')
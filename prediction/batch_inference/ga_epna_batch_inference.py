@@ -1,15 +1,20 @@
 from os import getenv
+from bisect import bisect_right
+import hashlib
+from time import time, process_time
 
+from pyspark import TaskContext
 from pyspark.sql import SparkSession, Window, functions as f
 
 from cassandra.cluster import Cluster
 from cassandra.auth import PlainTextAuthProvider
 
 import numpy as np
+import pandas as pd
 import torch as tr
-import torch.nn.functional as F
-import torch.nn as nn
-from collections import OrderedDict
+
+from ga_epna_model import get_model, CPU_CORES, INFERENCE_TASK_SLOTS, TORCH_INTRA_OP_THREADS, TORCH_INTER_OP_THREADS
+from ga_epna_model import MODEL_WEIGHTS_PATH, INFERENCE_BACKEND, HIT_FEATURES_COUNT
 
 MORPHL_SERVER_IP_ADDRESS = getenv('MORPHL_SERVER_IP_ADDRESS')
 MORPHL_CASSANDRA_USERNAME = getenv('MORPHL_CASSANDRA_USERNAME')
@@ -20,229 +25,46 @@ CASS_REQ_TIMEOUT = 3600.0
 
 PREDICTION_DAY_AS_STR = getenv('PREDICTION_DAY_AS_STR')
 
-MASTER_URL = 'local[*]'
+# One Spark task runs inference on each task slot of the core budget.
+MASTER_URL = f'local[{INFERENCE_TASK_SLOTS}]'
 APPLICATION_NAME = 'batch-inference'
 
+# Maximum number of users that go through the model in one forward pass.
+INFERENCE_BATCH_SIZE = int(getenv('INFERENCE_BATCH_SIZE', '256'))
 
-device = tr.device("cuda") if tr.cuda.is_available() else tr.device("cpu")
-
-# Model class used for predictions.
-
-
-class ModelLSTM_V1(nn.Module):
-    def __init__(self, inputShape, outputShape, hyperParameters={}, **kwargs):
-        super().__init__(**kwargs)
-
-        assert type(hyperParameters) == dict
-
-        self.hyperParameters = hyperParameters
-
-        self.appendPreviousOutput = hyperParameters["appendPreviousOutput"]
-        baseNeurons = hyperParameters["baseNeurons"]
-        self.hidenShape2 = baseNeurons + int(inputShape[1]) + outputShape \
-            if self.appendPreviousOutput else baseNeurons + int(inputShape[1])
-
-        self.lstm1 = nn.LSTM(input_size=int(
-            inputShape[2]), hidden_size=baseNeurons, num_layers=1)
-        self.lstm2 = nn.LSTM(input_size=self.hidenShape2,
-                             hidden_size=baseNeurons, num_layers=1)
-        self.fc1 = nn.Linear(in_features=baseNeurons +
-                             int(inputShape[0]), out_features=baseNeurons)
-        self.fc2 = nn.Linear(in_features=baseNeurons, out_features=outputShape)
-
-    def doLoadWeights(self, loadedState):
-        if not "weights" in loadedState and "params" in loadedState:
-            print(
-                "Warning: Depcrecated model, using \"params\" key instead of \"weights\".")
-            loadedState["weights"] = loadedState["params"]
-
-        assert "weights" in loadedState
-        params = loadedState["weights"]
-        loadedParams, _ = self.getNumParams(params)
-        trainableParams = self.getTrainableParameters()
-        thisParams, _ = self.getNumParams(trainableParams)
-        if loadedParams != thisParams:
-            raise Exception("Inconsistent parameters: %d vs %d." %
-                            (loadedParams, thisParams))
-
-        for i, item in enumerate(trainableParams):
-            with tr.no_grad():
-                item[:] = params[i][:].to(device)
-            item.requires_grad_(True)
-        print("Succesfully loaded weights (%d parameters) " % (loadedParams))
-
-    def loadModel(self, path, stateKeys):
-        assert len(stateKeys) > 0
-        try:
-            loadedState = tr.load(path)
-        except Exception:
-            print("Exception raised while loading model with tr.load(). Forcing CPU load")
-            loadedState = tr.load(
-                path, map_location=lambda storage, loc: storage)
-
-        print("Loading model from %s" % (path))
-        if not "model_state" in loadedState:
-            print(
-                "Warning, no model state dictionary for this model (obsolete behaviour). Ignoring.")
-            loadedState["model_state"] = None
-
-        if not self.onModelLoad(loadedState["model_state"]):
-            loaded = loadedState["model_state"]
-            current = self.onModelSave()
-            raise Exception(
-                "Could not correclty load the model state loaded: %s vs. current: %s" % (loaded, current))
-
-        self.doLoadWeights(loadedState)
-
-        print("Finished loading model")
-
-    def getNpData(self, results):
-        npResults = None
-        if results is None:
-            return None
-
-        if type(results) in (list, tuple):
-            npResults = []
-            for result in results:
-                npResult = self.getNpData(result)
-                npResults.append(npResult)
-        elif type(results) in (dict, OrderedDict):
-            npResults = {}
-            for key in results:
-                npResults[key] = self.getNpData(results[key])
-
-        elif type(results) == tr.Tensor:
-            npResults = results.detach().to('cpu').numpy()
-        else:
-            assert False, "Got type %s" % (type(results))
-        return npResults
-
-    def getTrData(self, data):
-        trData = None
-        if data is None:
-            return None
-
-        elif type(data) in (list, tuple):
-            trData = []
-            for item in data:
-                trItem = self.getTrData(item)
-                trData.append(trItem)
-        elif type(data) in (dict, OrderedDict):
-            trData = {}
-            for key in data:
-                trData[key] = self.getTrData(data[key])
-        elif type(data) is np.ndarray:
-            trData = tr.from_numpy(data).to(device)
-        elif type(data) is tr.Tensor:
-            trData = data.to(device)
-        return trData
-
-    def getNumParams(self, params):
-        numParams, numTrainable = 0, 0
-        for param in params:
-            npParamCount = np.prod(param.data.shape)
-            numParams += npParamCount
-            if param.requires_grad:
-                numTrainable += npParamCount
-        return numParams, numTrainable
-
-    def npForward(self, x):
-        trInput = self.getTrData(x)
-        trResult = self.forward(trInput)
-        npResult = self.getNpData(trResult)
-        return npResult
-
-    def onModelSave(self):
-        return self.hyperParameters
-
-    def onModelLoad(self, state):
-        if len(self.hyperParameters.keys()) != len(state.keys()):
-            return False
-
-        for key in state:
-            if not key in self.hyperParameters:
-                return False
-
-            if not state[key] == self.hyperParameters[key]:
-                return False
-
-        return True
-
-    def getTrainableParameters(self):
-        return list(filter(lambda p: p.requires_grad, self.parameters()))
-
-    def loadWeights(self, path):
-        self.loadModel(path, stateKeys=["weights", "model_state"])
-
-    def forward(self, trInputs):
-        # print(["%s=>%s" % (x, trInputs[x].shape) for x in trInputs])
-        hiddens = self.computeHiddens(trInputs)
-        # print(hiddens.shape)
-
-        # Append the features of previous session
-        X = trInputs["dataSessions"].transpose(0, 1).float()
-        X[1:] = X[0: -1]
-        X[0] *= 0
-        hiddens = tr.cat([X, hiddens], dim=-1)
-        # print(hiddens.shape)
-
-        # If using previous shopping stage as part of the hidden state, then we need to append it to the hidden state
-        #  vector. However, we need to append it accordingly (i.e. the output of session 0 to the hidden state of 1,
-        #  output of session 2 to the input state of 1 etc. The first session has a zeroed entry (no previous session).
-        if self.appendPreviousOutput:
-            X = trInputs["dataShoppingStage"].transpose(0, 1).float()
-            X[1:] = X[0: -1]
-            X[0] *= 0
-            hiddens = tr.cat([X, hiddens], dim=-1)
-        # print(hiddens.shape)
-
-        # [0] is the hidden state.
-        sess_hidden = self.lstm2(hiddens, None)[0]
-        # print(sess_hidden.shape)
-
-        # Append user features
-        X = trInputs["dataUsers"].float()
-        Y = tr.ones(sess_hidden.shape[0], *
-                    X.shape).to(device).requires_grad_(False)
-        Y = Y * X
-        sess_hidden = tr.cat([Y, sess_hidden], dim=-1)
-        # print(sess_hidden.shape)
-
-        sess_hidden = sess_hidden.transpose(0, 1)
-        y1 = F.relu(self.fc1(sess_hidden))
-        y2 = self.fc2(y1)
-
-        y3 = tr.sigmoid(y2)
-        
-        return y3
-
-    def computeHiddens(self, trInputs):
-        trData, trNums = trInputs["dataHits"], trInputs["dataNumItems"]
-        hiddens = []
-        numSessions = trData.shape[1]
-        MB = trData.shape[0]
-
-        # Session by session
-        for t_sessions in range(numSessions):
-            trSessData = trData[:, t_sessions]
-            trSessNums = trNums[:, t_sessions]
-            trSessData = tr.transpose(trSessData, 0, 1)
-            _, prevHidden = self.lstm1(trSessData[0: 1], None)
-            mask = tr.ones(prevHidden[0].shape).to(
-                device).requires_grad_(False)
-            N = tr.max(trSessNums)
-            # Hit by hit
-            for t_hits in range(1, N):
-                trSessNums -= 1
-                item = trSessData[t_hits: t_hits + 1]
-                _, hidden = self.lstm1(item, prevHidden)
-                hereMask = mask * \
-                    (trSessNums > 0).unsqueeze(0).unsqueeze(-1).float()
-                prevHidden = (prevHidden[0] * (1 - hereMask) + hidden[0] * hereMask,
-                              prevHidden[1] * (1 - hereMask) + hidden[1] * hereMask)
-            hiddens.append(prevHidden[0])
-        hiddens = tr.cat(hiddens, dim=0)
-        return hiddens
+SHOPPING_STAGES = [
+    'all_visits',
+    'product_view',
+    'add_to_cart',
+    'checkout_with_add_to_cart',
+    'checkout_without_add_to_cart',
+    'transaction',
+]
+
+# Format the batch inference data is sent to the Python workers in, rows as pickled
+# Row objects or arrow as Arrow batches with mapInPandas (Spark 3 and later).
+INFERENCE_INPUT_FORMAT = getenv('INFERENCE_INPUT_FORMAT', 'rows')
+
+# When true, the session level LSTM state of each user is stored after inference and
+# the next run only encodes the sessions the user had since then on top of it.
+STATEFUL_INFERENCE = getenv('STATEFUL_INFERENCE', 'false') == 'true'
+
+STATE_COLUMNS = ['last_session_id', 'lstm2_hidden', 'lstm2_cell',
+                 'last_session_features', 'last_shopping_stage']
+
+# When true, users whose inference inputs hash the same as at their previous prediction
+# reuse the stored probabilities and only the other users go through the model.
+INFERENCE_RESULT_CACHE = getenv('INFERENCE_RESULT_CACHE', 'false') == 'true'
+
+PREDICTIONS_SCHEMA = ', '.join(
+    ['client_id string'] + [f'{stage} double' for stage in SHOPPING_STAGES] + ['prediction_date string'])
+
+STATE_SCHEMA = ', '.join(
+    ['last_session_id string'] + [f'{column} binary' for column in STATE_COLUMNS[1:]])
+
+# The probabilities of each stage are counted in equal width bins over [0, 1].
+HISTOGRAM_BINS = 10
+PROBABILITY_QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
 
 
 # Return a spark dataframe from a specified Cassandra table.
@@ -274,8 +96,10 @@ def insert_statistics(statistics):
     insert_sql_parts = [
         'INSERT INTO ga_epna_predictions_statistics ',
         '(prediction_date, total_predictions, all_visits, product_view, checkout_with_add_to_cart,',
-        'transaction, add_to_cart, checkout_without_add_to_cart)'
-        'VALUES (?,?,?,?,?,?,?,?)',
+        'transaction, add_to_cart, checkout_without_add_to_cart, model_loads, model_load_seconds,',
+        'inference_seconds, cpu_efficiency, probability_histograms, probability_quantiles,',
+        'reused_predictions, cache_hit_rate)'
+        'VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
     ]
 
     insert_sql = ' '.join(insert_sql_parts)
@@ -290,51 +114,342 @@ def insert_statistics(statistics):
         statistics['checkout_with_add_to_cart'],
         statistics['transaction'],
         statistics['add_to_cart'],
-        statistics['checkout_without_add_to_cart']
+        statistics['checkout_without_add_to_cart'],
+        statistics['model_loads'],
+        statistics['model_load_seconds'],
+        statistics['inference_seconds'],
+        statistics['cpu_efficiency'],
+        statistics['probability_histograms'],
+        statistics['probability_quantiles'],
+        statistics['reused_predictions'],
+        statistics['cache_hit_rate']
     ]
 
     spark_session_cass.execute(
         prep_stmt_statistics, bind_list, timeout=CASS_REQ_TIMEOUT)
 
-# Map function that makes a prediction for each user
-def get_predictions(row):
+# Calculate the prediction statistics in a single aggregation. For each shopping
+# stage it counts the users with a probability over 0.5 and computes the histogram
+# and approximate quantiles of the probabilities.
+def calculate_statistics(ga_epna_predictions):
+    aggregations = [f.count(f.lit(1)).alias('total_predictions')]
+
+    for stage in SHOPPING_STAGES:
+        histogram_bin = f.least(
+            f.floor(f.col(stage) * HISTOGRAM_BINS), f.lit(HISTOGRAM_BINS - 1))
+
+        aggregations += [
+            f.coalesce(f.sum(f.when(f.col(stage) > 0.5, 1).otherwise(0)), f.lit(0)).alias(stage),
+            f.array(*[f.coalesce(f.sum(f.when(histogram_bin == i, 1).otherwise(0)), f.lit(0))
+                      for i in range(HISTOGRAM_BINS)]).alias(f'{stage}_histogram'),
+            f.expr('percentile_approx({}, array({}))'.format(
+                stage, ', '.join(map(str, PROBABILITY_QUANTILES)))).alias(f'{stage}_quantiles'),
+        ]
+
+    row = ga_epna_predictions.agg(*aggregations).first()
+
+    statistics = {'total_predictions': row.total_predictions}
+
+    for stage in SHOPPING_STAGES:
+        statistics[stage] = row[stage]
+
+    statistics['probability_histograms'] = {
+        stage: row[f'{stage}_histogram'] for stage in SHOPPING_STAGES}
+    statistics['probability_quantiles'] = {
+        stage: row[f'{stage}_quantiles'] or [] for stage in SHOPPING_STAGES}
+
+    return statistics
+
+# Return a fingerprint of the model the predictions are made with, so stored
+# predictions and states are not reused once the weights or the inference backend change.
+def get_model_fingerprint():
+    with open(MODEL_WEIGHTS_PATH, 'rb') as weights_file:
+        weights_hash = hashlib.sha256(weights_file.read()).hexdigest()
+
+    return '{}:{}'.format(INFERENCE_BACKEND, weights_hash)
+
+# Return the column with the hash of the inference inputs of each user. The feature
+# blobs are hashed together with the hit counts that give their shapes.
+def get_inputs_hash(model_fingerprint):
+    return f.sha2(f.concat(
+        f.lit(model_fingerprint).cast('binary'),
+        f.concat_ws(',', f.col('sessions_hits_count').cast('array<string>')).cast('binary'),
+        'user_features',
+        'sessions_features',
+        'hits_features',
+        'shopping_stages'), 256)
+
+# Read a float32 tensor blob of a batch inference data row without copying it.
+def get_tensor(row, column_name):
+    return np.frombuffer(row[column_name], dtype='<f4').reshape(row.tensor_shapes[column_name])
+
+# Rebuild the zero padded (sessions, max session hits, hit features) tensor of a user
+# from the hits of all sessions and the number of hits of each session.
+def pad_hits(hits, sessions_hits_count):
+    hits_count = np.array(sessions_hits_count)
+
+    # Positions of real hits in the padded tensor, in session then hit order
+    # which is the order the flat values are stored in.
+    hits_mask = np.arange(hits_count.max()) < hits_count[:, np.newaxis]
+
+    padded_hits = np.zeros(
+        hits_mask.shape + (HIT_FEATURES_COUNT,), dtype=np.float32)
+    padded_hits[hits_mask] = hits
+
+    return padded_hits
+
+# Return the mini-batch bucket of a user. Users of a batch must have the same number
+# of sessions since the prediction is made for the last one. The maximum number of hits
+# per session is rounded up to a power of two so the padding inside a batch stays small.
+def get_bucket(row):
+    max_hits = max(row.sessions_hits_count)
+    return (len(row.sessions_hits_count), 1 << (max_hits - 1).bit_length())
+
+# Input the numpy arrays of a batch into the model and only keep
+# the prediction for the most recent session of each user.
+def predict(model, sessions_array, hits_array, user_array, sessions_hits_count_array, shopping_stages):
+    with tr.no_grad():
+        result = model.npForward({"dataSessions": sessions_array,
+                                  "dataHits": hits_array,
+                                  "dataUsers": user_array,
+                                  "dataNumItems": sessions_hits_count_array,
+                                  "dataShoppingStage": shopping_stages})
+
+    return result[:, -1]
+
+# Return the model inputs of a batch of users with the same number of sessions.
+def get_batch_inputs(rows):
+
+    # Pad the hits of all users to the longest session of the batch.
+    max_hits = max(max(row.sessions_hits_count) for row in rows)
+    hits_array = np.zeros(
+        (len(rows), len(rows[0].sessions_hits_count), max_hits, HIT_FEATURES_COUNT), dtype=np.float32)
+
+    for i, row in enumerate(rows):
+        hits = pad_hits(get_tensor(row, 'hits_features'),
+                        row.sessions_hits_count)
+        hits_array[i, :, :hits.shape[1]] = hits
 
     # Get all the relevant numpy arrays
-    sessions_array = np.array([row.sessions_features]).astype(np.float32)
-    hits_array = np.array([row.hits_features]).astype(np.float32)
-    user_array = np.array([row.user_features]).astype(np.float32)
-    sessions_hits_count_array = np.array([row.sessions_hits_count])
-    shopping_stages = np.array([row.shopping_stages]).astype(np.float32)
-
-    # Input the numpy arrays into the modle
-    result = model.npForward({"dataSessions": sessions_array,
-                              "dataHits": hits_array,
-                              "dataUsers": user_array,
-                              "dataNumItems": sessions_hits_count_array,
-                              "dataShoppingStage": shopping_stages})
-
-    # Only keep the prediction for the most recent session
-    result = result[0][-1]
-
-    # Convert the result to a normal list of python floats
-    result = [float(i) for i in result.tolist()]
-
-    # Return the new row to the dataframe
-    return (row.client_id, result[0], result[1], result[2], result[3], result[4], result[5] ,PREDICTION_DAY_AS_STR)
-
-
-
+    return {"dataSessions": np.stack([get_tensor(row, 'sessions_features') for row in rows]),
+            "dataHits": hits_array,
+            "dataUsers": np.stack([get_tensor(row, 'user_features') for row in rows]),
+            "dataNumItems": np.array([row.sessions_hits_count for row in rows]),
+            "dataShoppingStage": np.stack([get_tensor(row, 'shopping_stages') for row in rows])}
+
+# Make predictions for a batch of users with the same number of sessions.
+def predict_batch(model, rows):
+    inputs = get_batch_inputs(rows)
+
+    result = predict(model, inputs["dataSessions"], inputs["dataHits"], inputs["dataUsers"],
+                     inputs["dataNumItems"], inputs["dataShoppingStage"])
+
+    # Return the new rows to the dataframe.
+    for row, user_result in zip(rows, result.tolist()):
+        yield (row.client_id, *user_result, PREDICTION_DAY_AS_STR)
+
+# mapPartitions function that groups the users of a partition into buckets
+# and makes the predictions one full bucket at a time. The model is loaded once
+# per Python worker and reused by all the tasks that run on it. on_cpu_time is
+# called with the CPU time the task used, torch threads included. When stateful
+# is true the users are encoded on top of their stored state.
+def get_partition_predictions(rows, on_model_load=None, on_cpu_time=None, stateful=False):
+    start_cpu_time = process_time()
+
+    if stateful:
+        bucket_of, predict_bucket = get_stateful_bucket, predict_stateful_batch
+    else:
+        bucket_of, predict_bucket = get_bucket, predict_batch
+
+    # Tasks that start together have consecutive partition ids, which
+    # spreads the first tasks of the workers over all the task slots.
+    task_slot = TaskContext.get().partitionId() % INFERENCE_TASK_SLOTS
+
+    model = get_model(on_model_load, task_slot)
+    buckets = {}
+
+    for row in rows:
+        bucket = buckets.setdefault(bucket_of(row), [])
+        bucket.append(row)
+
+        if len(bucket) == INFERENCE_BATCH_SIZE:
+            yield from predict_bucket(model, bucket)
+            bucket.clear()
+
+    # Predict the users left in partially filled buckets.
+    for bucket in buckets.values():
+        if bucket:
+            yield from predict_bucket(model, bucket)
+
+    if on_cpu_time is not None:
+        on_cpu_time(process_time() - start_cpu_time)
+
+# Return the index of the first session of a user that is not part of its stored
+# state, or None when the user has no state or no new sessions and is encoded
+# from the first session.
+def get_first_new_session(row):
+    if row.last_session_id is None:
+        return None
+
+    first_new_session = bisect_right(row.session_ids, row.last_session_id)
+
+    if first_new_session == len(row.session_ids):
+        return None
+
+    return first_new_session
+
+# Return the mini-batch bucket of a user for stateful inference, like get_bucket
+# but only counting the sessions that are encoded.
+def get_stateful_bucket(row):
+    sessions_hits_count = row.sessions_hits_count[get_first_new_session(row) or 0:]
+    max_hits = max(sessions_hits_count)
+    return (len(sessions_hits_count), 1 << (max_hits - 1).bit_length())
+
+# Make predictions for a batch of users with the same number of new sessions,
+# encoding them on top of the stored state of each user. Users without a state
+# start from a zero state and zero previous session, which is what forward uses.
+# The new state of each user is returned after its predictions.
+def predict_stateful_batch(model, rows):
+    hidden_size = model.lstm2.hidden_size
+
+    first_sessions = [get_first_new_session(row) for row in rows]
+    sessions_count = len(rows[0].sessions_hits_count) - (first_sessions[0] or 0)
+
+    sessions_array, shopping_stages, sessions_hits_count_array = [], [], []
+    previous_sessions, previous_shopping_stages = [], []
+    hidden_array, cell_array = [], []
+
+    max_hits = max(max(row.sessions_hits_count[first or 0:])
+                   for row, first in zip(rows, first_sessions))
+    hits_array = np.zeros(
+        (len(rows), sessions_count, max_hits, HIT_FEATURES_COUNT), dtype=np.float32)
+
+    for i, (row, first) in enumerate(zip(rows, first_sessions)):
+        start = first or 0
+        sessions_hits_count = row.sessions_hits_count[start:]
+
+        # Skip the hits of the sessions that are already part of the state.
+        hits = get_tensor(row, 'hits_features')[sum(row.sessions_hits_count[:start]):]
+        hits = pad_hits(hits, sessions_hits_count)
+        hits_array[i, :, :hits.shape[1]] = hits
+
+        sessions = get_tensor(row, 'sessions_features')[start:]
+        stages = get_tensor(row, 'shopping_stages')[start:]
+
+        sessions_array.append(sessions)
+        shopping_stages.append(stages)
+        sessions_hits_count_array.append(sessions_hits_count)
+
+        if first is None:
+            previous_sessions.append(np.zeros(sessions.shape[1:], dtype=np.float32))
+            previous_shopping_stages.append(np.zeros(stages.shape[1:], dtype=np.float32))
+            hidden_array.append(np.zeros(hidden_size, dtype=np.float32))
+            cell_array.append(np.zeros(hidden_size, dtype=np.float32))
+        else:
+            previous_sessions.append(np.frombuffer(row.last_session_features, dtype='<f4'))
+            previous_shopping_stages.append(np.frombuffer(row.last_shopping_stage, dtype='<f4'))
+            hidden_array.append(np.frombuffer(row.lstm2_hidden, dtype='<f4'))
+            cell_array.append(np.frombuffer(row.lstm2_cell, dtype='<f4'))
+
+    with tr.no_grad():
+        result, hidden, cell = model.npForwardSessions({
+            "dataSessions": np.stack(sessions_array),
+            "dataHits": hits_array,
+            "dataUsers": np.stack([get_tensor(row, 'user_features') for row in rows]),
+            "dataNumItems": np.array(sessions_hits_count_array),
+            "dataShoppingStage": np.stack(shopping_stages),
+            "previousSessions": np.stack(previous_sessions),
+            "previousShoppingStage": np.stack(previous_shopping_stages),
+            # The LSTM state has a leading layers dimension.
+            "lstm2Hidden": np.stack(hidden_array)[np.newaxis],
+            "lstm2Cell": np.stack(cell_array)[np.newaxis]})
+
+    # Return the new rows to the dataframe.
+    for i, (row, user_result) in enumerate(zip(rows, result[:, -1].tolist())):
+        yield (row.client_id, *user_result, PREDICTION_DAY_AS_STR,
+               row.session_ids[-1],
+               hidden[0, i].astype('<f4').tobytes(),
+               cell[0, i].astype('<f4').tobytes(),
+               get_tensor(row, 'sessions_features')[-1].tobytes(),
+               get_tensor(row, 'shopping_stages')[-1].tobytes())
+
+# Join the float32 blobs of a column into a single (rows, features) array.
+def join_blobs(blobs, rows_count):
+    return np.frombuffer(b''.join(blobs), dtype='<f4').reshape(rows_count, -1)
+
+# Return where each run starts when runs of the given lengths are concatenated.
+def get_offsets(lengths):
+    return np.cumsum(lengths) - lengths
+
+# Make the predictions for an Arrow batch of users. The blobs of each feature
+# column are joined into one numpy array and the tensors of each mini-batch
+# are gathered from them with index arrays.
+def predict_arrow_batch(model, batch):
+    sessions_count = batch.sessions_hits_count.str.len().to_numpy()
+    session_hits_count = np.concatenate(batch.sessions_hits_count.to_numpy())
+
+    session_offsets = get_offsets(sessions_count)
+    hit_offsets = get_offsets(session_hits_count)
+
+    user_features = join_blobs(batch.user_features, len(batch))
+    sessions_features = join_blobs(
+        batch.sessions_features, len(session_hits_count))
+    shopping_stages = join_blobs(
+        batch.shopping_stages, len(session_hits_count))
+    hits_features = join_blobs(batch.hits_features, session_hits_count.sum())
+
+    # Bucket the users like get_bucket does.
+    max_hits = np.maximum.reduceat(session_hits_count, session_offsets)
+    hits_bucket = 2 ** np.ceil(np.log2(max_hits)).astype(np.int64)
+    _, bucket_ids = np.unique(
+        np.stack([sessions_count, hits_bucket], axis=1), axis=0, return_inverse=True)
+
+    users_by_bucket = np.argsort(bucket_ids.ravel(), kind='stable')
+    bucket_starts = np.flatnonzero(
+        np.diff(bucket_ids.ravel()[users_by_bucket], prepend=-1))
+
+    predictions = np.zeros((len(batch), len(SHOPPING_STAGES)))
+
+    for bucket_users in np.split(users_by_bucket, bucket_starts[1:]):
+        for start in range(0, len(bucket_users), INFERENCE_BATCH_SIZE):
+            users = bucket_users[start: start + INFERENCE_BATCH_SIZE]
+
+            # (users, sessions) indexes of the sessions of the mini-batch.
+            session_ids = session_offsets[users][:, np.newaxis] + \
+                np.arange(sessions_count[users[0]])
+            hits_count = session_hits_count[session_ids]
+
+            # Pad the hits of all users to the longest session of the mini-batch.
+            hits_mask = np.arange(hits_count.max()) < hits_count[..., np.newaxis]
+            hit_ids = hit_offsets[session_ids][..., np.newaxis] + \
+                np.arange(hits_count.max())
+
+            hits_array = np.zeros(
+                hits_mask.shape + (HIT_FEATURES_COUNT,), dtype=np.float32)
+            hits_array[hits_mask] = hits_features[hit_ids[hits_mask]]
+
+            predictions[users] = predict(model, sessions_features[session_ids], hits_array,
+                                         user_features[users], hits_count, shopping_stages[session_ids])
+
+    result = pd.DataFrame(predictions, columns=SHOPPING_STAGES)
+    result.insert(0, 'client_id', batch.client_id.to_numpy())
+    result['prediction_date'] = PREDICTION_DAY_AS_STR
+
+    return result
+
+# mapInPandas function that makes the predictions one Arrow batch at a time.
+def get_arrow_predictions(batches, on_model_load=None, on_cpu_time=None):
+    start_cpu_time = process_time()
+
+    task_slot = TaskContext.get().partitionId() % INFERENCE_TASK_SLOTS
+    model = get_model(on_model_load, task_slot)
+
+    for batch in batches:
+        yield predict_arrow_batch(model, batch)
+
+    if on_cpu_time is not None:
+        on_cpu_time(process_time() - start_cpu_time)
 
-# Load the model
-model = ModelLSTM_V1(inputShape=(8, 14, 8), outputShape=6, hyperParameters={"randomizeSessionSize": True,
-                                                                             "appendPreviousOutput": True,
-                                                                             "baseNeurons": 30,
-                                                                             "lookaheadSessions": 1,
-                                                                             'normalization': 'min_max',
-                                                                             'inShape': (8, 14, 8),
-                                                                             "attributionModeling": "linear"})
-# Load the model weights.
-model.loadWeights('/opt/models/ga_epna_model_weights.pkl')
 
 def main():
     spark_session = (
@@ -362,37 +477,130 @@ def main():
     batch_inference_data = fetch_from_cassandra('ga_epna_batch_inference_data', spark_session).join(
         current_day_ids, 'client_id', 'inner')
 
-    # Convert the dataframe to an rdd so we can apply the mapping function to it
-    ga_epna_predictions = (
-        batch_inference_data.
-        rdd.
-        map(get_predictions).
-        repartition(32)
-        .toDF([
-            'client_id',
-            'all_visits',
-            'product_view',
-            'add_to_cart',
-            'checkout_with_add_to_cart',
-            'checkout_without_add_to_cart',
-            'transaction',
-            'prediction_date',
-        ])
-    )
-
-    # Cache the df since we will run multiple queries on it 
+    if STATEFUL_INFERENCE:
+        if INFERENCE_INPUT_FORMAT == 'arrow':
+            raise Exception('Stateful inference is only supported with the rows input format')
+
+        # The traced module only returns the predictions, so it has no states to store.
+        if INFERENCE_BACKEND == 'torchscript':
+            raise Exception('Stateful inference is not supported by the torchscript backend')
+
+        # States made by another model, after new weights or a backend change, are ignored.
+        model_fingerprint = get_model_fingerprint()
+
+        # Add the stored state of the users, users without one are encoded from their first session.
+        inference_state = (
+            fetch_from_cassandra('ga_epna_inference_state', spark_session).
+            where(f.col('model_fingerprint') == model_fingerprint).
+            drop('model_fingerprint')
+        )
+        batch_inference_data = batch_inference_data.join(inference_state, 'client_id', 'left')
+
+    if INFERENCE_RESULT_CACHE:
+        batch_inference_data = batch_inference_data.withColumn(
+            'inputs_hash', get_inputs_hash(get_model_fingerprint()))
+
+        inputs_hashes = batch_inference_data.select('client_id', 'inputs_hash').cache()
+
+        # Reuse the previous probabilities of the users whose inputs did not change.
+        previous_predictions = fetch_from_cassandra('ga_epna_predictions', spark_session).select(
+            'client_id', 'inputs_hash', *SHOPPING_STAGES)
+
+        reused_predictions = (
+            inputs_hashes.
+            join(previous_predictions, ['client_id', 'inputs_hash'], 'inner').
+            select('client_id', *SHOPPING_STAGES,
+                   f.lit(PREDICTION_DAY_AS_STR).alias('prediction_date'), 'inputs_hash').
+            cache()
+        )
+
+        # Only the users with changed inputs go through the model.
+        batch_inference_data = batch_inference_data.join(
+            reused_predictions.select('client_id'), 'client_id', 'left_anti')
+
+    # Count the model loads on the workers and the time they took.
+    model_loads = spark_session.sparkContext.accumulator(0)
+    model_load_seconds = spark_session.sparkContext.accumulator(0.0)
+
+    def record_model_load(seconds):
+        model_loads.add(1)
+        model_load_seconds.add(seconds)
+
+    # CPU time the inference tasks used, to tell how well the core budget is used.
+    inference_cpu_seconds = spark_session.sparkContext.accumulator(0.0)
+
+    print('Core budget: %d cores, %d task slots, %d intra-op and %d inter-op torch threads per slot' %
+          (CPU_CORES, INFERENCE_TASK_SLOTS, TORCH_INTRA_OP_THREADS, TORCH_INTER_OP_THREADS))
+
+    if INFERENCE_INPUT_FORMAT == 'arrow':
+        # Send the feature columns to the workers as Arrow batches, the tensor shapes
+        # are not needed since the blobs are reshaped from the session counts.
+        ga_epna_predictions = (
+            batch_inference_data.
+            select('client_id', 'user_features', 'sessions_features', 'hits_features',
+                   'sessions_hits_count', 'shopping_stages').
+            mapInPandas(lambda batches: get_arrow_predictions(
+                batches, record_model_load, inference_cpu_seconds.add), PREDICTIONS_SCHEMA).
+            repartition(32)
+        )
+    elif STATEFUL_INFERENCE:
+        # Make the predictions like below and keep the new state of each user next to them.
+        ga_epna_predictions_with_state = (
+            batch_inference_data.
+            rdd.
+            mapPartitions(lambda rows: get_partition_predictions(
+                rows, record_model_load, inference_cpu_seconds.add, stateful=True)).
+            repartition(32)
+            .toDF(f'{PREDICTIONS_SCHEMA}, {STATE_SCHEMA}')
+        )
+
+        # Cache the df since the predictions and the state are saved from it
+        ga_epna_predictions_with_state.cache()
+
+        ga_epna_predictions = ga_epna_predictions_with_state.select(
+            'client_id', *SHOPPING_STAGES, 'prediction_date')
+    else:
+        # Convert the dataframe to an rdd so we can make the predictions in mini-batches.
+        # toDF is given the schema, inferring it would run the predictions right away.
+        ga_epna_predictions = (
+            batch_inference_data.
+            rdd.
+            mapPartitions(lambda rows: get_partition_predictions(
+                rows, record_model_load, inference_cpu_seconds.add)).
+            repartition(32)
+            .toDF(PREDICTIONS_SCHEMA)
+        )
+
+    if INFERENCE_RESULT_CACHE:
+        # Store the inputs hash next to the new predictions and add the reused ones.
+        ga_epna_predictions = ga_epna_predictions.join(
+            inputs_hashes, 'client_id').unionByName(reused_predictions)
+
+    # Cache the df since the predictions are saved after the statistics are calculated
     ga_epna_predictions.cache()
 
-    # Calculate all the probability statistics
-    statistics = {
-        'total_predictions': ga_epna_predictions.count(),
-        'all_visits': ga_epna_predictions.where("all_visits > 0.5").count(),
-        'product_view': ga_epna_predictions.where("product_view > 0.5").count(),
-        'add_to_cart': ga_epna_predictions.where("add_to_cart > 0.5").count(),
-        'checkout_with_add_to_cart': ga_epna_predictions.where("checkout_with_add_to_cart > 0.5").count(),
-        'checkout_without_add_to_cart': ga_epna_predictions.where("checkout_without_add_to_cart > 0.5").count(),
-        'transaction': ga_epna_predictions.where("transaction > 0.5").count(),
-    }
+    # Calculate all the probability statistics, the predictions are made by this action.
+    start = time()
+    statistics = calculate_statistics(ga_epna_predictions)
+    inference_seconds = time() - start
+
+    statistics.update({
+        'model_loads': model_loads.value,
+        'model_load_seconds': model_load_seconds.value,
+        'inference_seconds': inference_seconds,
+        'cpu_efficiency': inference_cpu_seconds.value / (inference_seconds * CPU_CORES),
+        'reused_predictions': reused_predictions.count() if INFERENCE_RESULT_CACHE else 0,
+    })
+
+    statistics['cache_hit_rate'] = (statistics['reused_predictions'] / statistics['total_predictions']
+                                    if statistics['total_predictions'] else 0.0)
+
+    print('Model loads: %d, total load time: %.2fs' %
+          (statistics['model_loads'], statistics['model_load_seconds']))
+    print('Inference time: %.2fs, CPU efficiency: %.2f' %
+          (statistics['inference_seconds'], statistics['cpu_efficiency']))
+    print('Reused predictions: %d, cache hit rate: %.2f' %
+          (statistics['reused_predictions'], statistics['cache_hit_rate']))
 
     # Save the statistics to Cassandra 
     insert_statistics(statistics)
@@ -411,6 +619,22 @@ def main():
      save()
      )
 
+    if STATEFUL_INFERENCE:
+        # Save the new state of the users to Cassandra
+        save_options_ga_epna_inference_state = {
+            'keyspace': MORPHL_CASSANDRA_KEYSPACE,
+            'table': ('ga_epna_inference_state')
+        }
+
+        (ga_epna_predictions_with_state.
+         select('client_id', *STATE_COLUMNS, f.lit(model_fingerprint).alias('model_fingerprint')).
+         write.
+         format('org.apache.spark.sql.cassandra').
+         mode('append').
+         options(**save_options_ga_epna_inference_state).
+         save()
+         )
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,84 @@
+from os import getenv
+import sys
+
+import numpy as np
+import torch as tr
+
+from ga_epna_model import load_eager_model, device, HIT_FEATURES_COUNT
+
+CHECK_BATCH_SIZE = 16
+CHECK_SESSIONS_COUNTS = [1, 2, 5, 12]
+CHECK_MAX_HITS = [1, 4, 30]
+CHECK_TOLERANCE = float(getenv('CHECK_TOLERANCE', '1e-5'))
+
+# The hit by hit loop computeHiddens used before the sessions were packed,
+# kept as the reference the packed encoder is compared against.
+def compute_hiddens_loop(model, trInputs):
+    trData, trNums = trInputs["dataHits"], trInputs["dataNumItems"].clone()
+    hiddens = []
+    numSessions = trData.shape[1]
+
+    # Session by session
+    for t_sessions in range(numSessions):
+        trSessData = trData[:, t_sessions]
+        trSessNums = trNums[:, t_sessions]
+        trSessData = tr.transpose(trSessData, 0, 1)
+        _, prevHidden = model.lstm1(trSessData[0: 1], None)
+        mask = tr.ones(prevHidden[0].shape).to(
+            device).requires_grad_(False)
+        N = tr.max(trSessNums)
+        # Hit by hit
+        for t_hits in range(1, N):
+            trSessNums -= 1
+            item = trSessData[t_hits: t_hits + 1]
+            _, hidden = model.lstm1(item, prevHidden)
+            hereMask = mask * \
+                (trSessNums > 0).unsqueeze(0).unsqueeze(-1).float()
+            prevHidden = (prevHidden[0] * (1 - hereMask) + hidden[0] * hereMask,
+                          prevHidden[1] * (1 - hereMask) + hidden[1] * hereMask)
+        hiddens.append(prevHidden[0])
+    hiddens = tr.cat(hiddens, dim=0)
+    return hiddens
+
+# Return random zero padded hits and hit counts for a batch of users.
+def get_random_hits(model, sessions_count, max_hits):
+    hits_count = np.random.randint(
+        1, max_hits + 1, size=(CHECK_BATCH_SIZE, sessions_count))
+    hits_mask = np.arange(max_hits) < hits_count[..., np.newaxis]
+
+    hits = np.zeros(hits_mask.shape + (HIT_FEATURES_COUNT,), dtype=np.float32)
+    hits[hits_mask] = np.random.rand(hits_mask.sum(), HIT_FEATURES_COUNT)
+
+    return model.getTrData({"dataHits": hits, "dataNumItems": hits_count})
+
+
+def main():
+    np.random.seed(0)
+
+    model = load_eager_model()
+
+    max_difference = 0.0
+
+    with tr.no_grad():
+        for sessions_count in CHECK_SESSIONS_COUNTS:
+            for max_hits in CHECK_MAX_HITS:
+                trInputs = get_random_hits(model, sessions_count, max_hits)
+
+                difference = (model.computeHiddens(trInputs) -
+                              compute_hiddens_loop(model, trInputs)).abs().max().item()
+
+                print('Sessions: %d, max hits: %d, max difference: %g' %
+                      (sessions_count, max_hits, difference))
+
+                max_difference = max(max_difference, difference)
+
+    if max_difference > CHECK_TOLERANCE:
+        print('Packed hit encoder differs from the hit loop by %g' %
+              max_difference)
+        sys.exit(1)
+
+    print('Packed hit encoder matches the hit loop')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+from os import getenv, sched_getaffinity, sched_setaffinity
+from time import time
+
+import numpy as np
+import torch as tr
+import torch.nn.functional as F
+import torch.nn as nn
+from collections import OrderedDict
+
+MODELS_DIR = getenv('MODELS_DIR', '/opt/models')
+MODEL_WEIGHTS_PATH = f'{MODELS_DIR}/ga_epna_model_weights.pkl'
+TORCHSCRIPT_MODEL_PATH = f'{MODELS_DIR}/ga_epna_model_torchscript.pt'
+
+# Model used for inference, eager runs ModelLSTM_V1, quantized runs it with dynamic
+# int8 LSTM and linear layers and torchscript runs the graph exported by
+# ga_epna_model_export.py.
+INFERENCE_BACKEND = getenv('INFERENCE_BACKEND', 'eager')
+
+# Cores the process may run on when it starts.
+AVAILABLE_CPUS = sorted(sched_getaffinity(0))
+
+# The cores inference may use are split between the Spark tasks that run at the
+# same time and the torch threads of each task, so that slots * threads = cores.
+# By default every core runs one task with a single torch thread.
+CPU_CORES = int(getenv('CPU_CORES', '0')) or len(AVAILABLE_CPUS)
+INFERENCE_TASK_SLOTS = min(
+    int(getenv('INFERENCE_TASK_SLOTS', '0')) or CPU_CORES, CPU_CORES)
+
+# Number of threads torch uses inside an operation, 0 uses the cores left for each task slot.
+TORCH_INTRA_OP_THREADS = int(
+    getenv('TORCH_INTRA_OP_THREADS', '0')) or CPU_CORES // INFERENCE_TASK_SLOTS
+
+# Number of threads torch uses to run independent operations, the model runs
+# its operations one after the other.
+TORCH_INTER_OP_THREADS = int(getenv('TORCH_INTER_OP_THREADS', '1'))
+
+# Pin the Python worker of each task slot to its own cores.
+INFERENCE_CPU_PINNING = getenv('INFERENCE_CPU_PINNING', 'false') == 'true'
+
+device = tr.device("cuda") if tr.cuda.is_available() else tr.device("cpu")
+
+HIT_FEATURES_COUNT = 8
+
+# Model class used for predictions.
+
+
+class ModelLSTM_V1(nn.Module):
+    def __init__(self, inputShape, outputShape, hyperParameters={}, **kwargs):
+        super().__init__(**kwargs)
+
+        assert type(hyperParameters) == dict
+
+        self.hyperParameters = hyperParameters
+
+        self.appendPreviousOutput = hyperParameters["appendPreviousOutput"]
+        baseNeurons = hyperParameters["baseNeurons"]
+        self.hidenShape2 = baseNeurons + int(inputShape[1]) + outputShape \
+            if self.appendPreviousOutput else baseNeurons + int(inputShape[1])
+
+        self.lstm1 = nn.LSTM(input_size=int(
+            inputShape[2]), hidden_size=baseNeurons, num_layers=1)
+        self.lstm2 = nn.LSTM(input_size=self.hidenShape2,
+                             hidden_size=baseNeurons, num_layers=1)
+        self.fc1 = nn.Linear(in_features=baseNeurons +
+                             int(inputShape[0]), out_features=baseNeurons)
+        self.fc2 = nn.Linear(in_features=baseNeurons, out_features=outputShape)
+
+    def doLoadWeights(self, loadedState):
+        if not "weights" in loadedState and "params" in loadedState:
+            print(
+                "Warning: Depcrecated model, using \"params\" key instead of \"weights\".")
+            loadedState["weights"] = loadedState["params"]
+
+        assert "weights" in loadedState
+        params = loadedState["weights"]
+        loadedParams, _ = self.getNumParams(params)
+        trainableParams = self.getTrainableParameters()
+        thisParams, _ = self.getNumParams(trainableParams)
+        if loadedParams != thisParams:
+            raise Exception("Inconsistent parameters: %d vs %d." %
+                            (loadedParams, thisParams))
+
+        for i, item in enumerate(trainableParams):
+            with tr.no_grad():
+                item[:] = params[i][:].to(device)
+            item.requires_grad_(True)
+        print("Succesfully loaded weights (%d parameters) " % (loadedParams))
+
+    def loadModel(self, path, stateKeys):
+        assert len(stateKeys) > 0
+        try:
+            # Memory map the weights instead of reading the whole file, older
+            # model files that can not be memory mapped are read normally.
+            loadedState = tr.load(path, map_location='cpu', mmap=True)
+        except Exception:
+            print("Exception raised while memory mapping the model with tr.load(). Forcing CPU load")
+            loadedState = tr.load(
+                path, map_location=lambda storage, loc: storage)
+
+        print("Loading model from %s" % (path))
+        if not "model_state" in loadedState:
+            print(
+                "Warning, no model state dictionary for this model (obsolete behaviour). Ignoring.")
+            loadedState["model_state"] = None
+
+        if not self.onModelLoad(loadedState["model_state"]):
+            loaded = loadedState["model_state"]
+            current = self.onModelSave()
+            raise Exception(
+                "Could not correclty load the model state loaded: %s vs. current: %s" % (loaded, current))
+
+        self.doLoadWeights(loadedState)
+
+        print("Finished loading model")
+
+    def getNpData(self, results):
+        npResults = None
+        if results is None:
+            return None
+
+        if type(results) in (list, tuple):
+            npResults = []
+            for result in results:
+                npResult = self.getNpData(result)
+                npResults.append(npResult)
+        elif type(results) in (dict, OrderedDict):
+            npResults = {}
+            for key in results:
+                npResults[key] = self.getNpData(results[key])
+
+        elif type(results) == tr.Tensor:
+            npResults = results.detach().to('cpu').numpy()
+        else:
+            assert False, "Got type %s" % (type(results))
+        return npResults
+
+    def getTrData(self, data):
+        trData = None
+        if data is None:
+            return None
+
+        elif type(data) in (list, tuple):
+            trData = []
+            for item in data:
+                trItem = self.getTrData(item)
+                trData.append(trItem)
+        elif type(data) in (dict, OrderedDict):
+            trData = {}
+            for key in data:
+                trData[key] = self.getTrData(data[key])
+        elif type(data) is np.ndarray:
+            trData = tr.from_numpy(data).to(device)
+        elif type(data) is tr.Tensor:
+            trData = data.to(device)
+        return trData
+
+    def getNumParams(self, params):
+        numParams, numTrainable = 0, 0
+        for param in params:
+            npParamCount = np.prod(param.data.shape)
+            numParams += npParamCount
+            if param.requires_grad:
+                numTrainable += npParamCount
+        return numParams, numTrainable
+
+    def npForward(self, x):
+        trInput = self.getTrData(x)
+        trResult = self.forward(trInput)
+        npResult = self.getNpData(trResult)
+        return npResult
+
+    def onModelSave(self):
+        return self.hyperParameters
+
+    def onModelLoad(self, state):
+        if len(self.hyperParameters.keys()) != len(state.keys()):
+            return False
+
+        for key in state:
+            if not key in self.hyperParameters:
+                return False
+
+            if not state[key] == self.hyperParameters[key]:
+                return False
+
+        return True
+
+    def getTrainableParameters(self):
+        return list(filter(lambda p: p.requires_grad, self.parameters()))
+
+    def loadWeights(self, path):
+        self.loadModel(path, stateKeys=["weights", "model_state"])
+
+    def npForwardSessions(self, x):
+        trInput = self.getTrData(x)
+        trResult, (trHidden, trCell) = self.forwardSessions(trInput)
+        return self.getNpData(trResult), self.getNpData(trHidden), self.getNpData(trCell)
+
+    def forward(self, trInputs):
+        return self.forwardSessions(trInputs)[0]
+
+    # Run the model and also return the lstm2 state after the last session.
+    # The sessions are encoded on top of a stored state when trInputs holds
+    # "lstm2Hidden" and "lstm2Cell", and "previousSessions" and
+    # "previousShoppingStage" then hold the features of the session before them.
+    def forwardSessions(self, trInputs):
+        # print(["%s=>%s" % (x, trInputs[x].shape) for x in trInputs])
+        hiddens = self.computeHiddens(trInputs)
+        # print(hiddens.shape)
+
+        # Append the features of previous session
+        X = trInputs["dataSessions"].transpose(0, 1).float()
+        X[1:] = X[0: -1].clone()
+        if "previousSessions" in trInputs:
+            X[0] = trInputs["previousSessions"].float()
+        else:
+            X[0] *= 0
+        hiddens = tr.cat([X, hiddens], dim=-1)
+        # print(hiddens.shape)
+
+        # If using previous shopping stage as part of the hidden state, then we need to append it to the hidden state
+        #  vector. However, we need to append it accordingly (i.e. the output of session 0 to the hidden state of 1,
+        #  output of session 2 to the input state of 1 etc. The first session has a zeroed entry (no previous session).
+        if self.appendPreviousOutput:
+            X = trInputs["dataShoppingStage"].transpose(0, 1).float()
+            X[1:] = X[0: -1].clone()
+            if "previousShoppingStage" in trInputs:
+                X[0] = trInputs["previousShoppingStage"].float()
+            else:
+                X[0] *= 0
+            hiddens = tr.cat([X, hiddens], dim=-1)
+        # print(hiddens.shape)
+
+        prevState = None
+        if "lstm2Hidden" in trInputs:
+            prevState = (trInputs["lstm2Hidden"].float(),
+                         trInputs["lstm2Cell"].float())
+
+        # [0] is the hidden state.
+        sess_hidden, state = self.lstm2(hiddens, prevState)
+        # print(sess_hidden.shape)
+
+        # Append user features
+        X = trInputs["dataUsers"].float()
+        Y = tr.ones(sess_hidden.shape[0], *
+                    X.shape).to(device).requires_grad_(False)
+        Y = Y * X
+        sess_hidden = tr.cat([Y, sess_hidden], dim=-1)
+        # print(sess_hidden.shape)
+
+        sess_hidden = sess_hidden.transpose(0, 1)
+        y1 = F.relu(self.fc1(sess_hidden))
+        y2 = self.fc2(y1)
+
+        y3 = tr.sigmoid(y2)
+        
+        return y3, state
+
+    def computeHiddens(self, trInputs):
+        trData, trNums = trInputs["dataHits"], trInputs["dataNumItems"]
+        MB, numSessions = trData.shape[0], trData.shape[1]
+
+        # All the sessions of the batch go through lstm1 in one call as a packed
+        # sequence, the first hit of a session is always used.
+        trSessData = trData.reshape(MB * numSessions, *trData.shape[2:])
+        trSessNums = trNums.reshape(-1).clamp(min=1).to('cpu')
+        packedData = nn.utils.rnn.pack_padded_sequence(
+            trSessData, trSessNums, batch_first=True, enforce_sorted=False)
+
+        # The last hidden state of each session, sessions first like the lstm2 input.
+        _, (hiddens, _) = self.lstm1(packedData)
+        hiddens = hiddens[0].view(MB, numSessions, -1).transpose(0, 1)
+        return hiddens
+
+
+# Build the eager model and load its weights.
+def load_eager_model():
+    model = ModelLSTM_V1(inputShape=(8, 14, 8), outputShape=6, hyperParameters={"randomizeSessionSize": True,
+                                                                                 "appendPreviousOutput": True,
+                                                                                 "baseNeurons": 30,
+                                                                                 "lookaheadSessions": 1,
+                                                                                 'normalization': 'min_max',
+                                                                                 'inShape': (8, 14, 8),
+                                                                                 "attributionModeling": "linear"})
+    model.loadWeights(MODEL_WEIGHTS_PATH)
+
+    return model
+
+
+# Return a copy of the model with dynamic int8 weights for the LSTM and linear layers.
+def quantize_model(model):
+    return tr.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=tr.qint8)
+
+
+# Runs the TorchScript graph of the model behind the npForward interface of the eager model.
+class TorchScriptModel:
+    def __init__(self, path):
+        self.module = tr.jit.load(path, map_location=device)
+        print("Loaded TorchScript model from %s" % (path))
+
+    def npForward(self, x):
+        trInputs = {key: tr.from_numpy(value).to(device)
+                    for key, value in x.items()}
+        return self.module(trInputs).detach().to('cpu').numpy()
+
+    # The traced module only returns the predictions.
+    def npForwardSessions(self, x):
+        raise Exception("Stateful inference is not supported by the torchscript backend")
+
+
+# Return random model inputs for a batch of users.
+def get_random_inputs(users_count, sessions_count, max_hits):
+    hits_count = np.random.randint(
+        1, max_hits + 1, size=(users_count, sessions_count))
+    hits_mask = np.arange(max_hits) < hits_count[..., np.newaxis]
+
+    hits = np.zeros(hits_mask.shape + (HIT_FEATURES_COUNT,), dtype=np.float32)
+    hits[hits_mask] = np.random.rand(hits_mask.sum(), HIT_FEATURES_COUNT)
+
+    shopping_stages = np.eye(6, dtype=np.float32)[
+        np.random.randint(0, 6, size=(users_count, sessions_count))]
+
+    return {"dataSessions": np.random.rand(users_count, sessions_count, 14).astype(np.float32),
+            "dataHits": hits,
+            "dataUsers": np.random.rand(users_count, 8).astype(np.float32),
+            "dataNumItems": hits_count,
+            "dataShoppingStage": shopping_stages}
+
+
+# Return the model that runs on the given inference backend.
+def load_model(backend):
+    if backend == 'eager':
+        return load_eager_model()
+
+    if backend == 'quantized':
+        return quantize_model(load_eager_model())
+
+    if backend == 'torchscript':
+        return TorchScriptModel(TORCHSCRIPT_MODEL_PATH)
+
+    raise Exception("Unknown inference backend: %s" % (backend))
+
+
+# Pin the calling process to the cores of a task slot. Threads torch starts
+# afterwards inherit them.
+def pin_to_task_slot(task_slot):
+    first_cpu = task_slot * TORCH_INTRA_OP_THREADS
+    cpus = {AVAILABLE_CPUS[(first_cpu + i) % len(AVAILABLE_CPUS)]
+            for i in range(TORCH_INTRA_OP_THREADS)}
+
+    sched_setaffinity(0, cpus)
+    print("Pinned task slot %d to cpus %s" % (task_slot, sorted(cpus)))
+
+
+# Model of this Python worker, loaded by the first task that needs it.
+model = None
+
+# Return the model of this Python worker, loading it the first time.
+# on_load is called with the load time in seconds when the model is loaded.
+# The worker is pinned to the cores of task_slot first when pinning is enabled.
+def get_model(on_load=None, task_slot=None):
+    global model
+
+    if model is None:
+        start = time()
+
+        if INFERENCE_CPU_PINNING and task_slot is not None:
+            pin_to_task_slot(task_slot)
+
+        tr.set_num_threads(TORCH_INTRA_OP_THREADS)
+        tr.set_num_interop_threads(TORCH_INTER_OP_THREADS)
+
+        model = load_model(INFERENCE_BACKEND)
+
+        if on_load is not None:
+            on_load(time() - start)
+
+    return model
@@ -0,0 +1,146 @@
+from os import getenv
+from os.path import exists
+from time import perf_counter
+from contextlib import redirect_stdout
+import io
+import json
+import multiprocessing
+import platform
+import resource
+
+import numpy as np
+import torch as tr
+
+import ga_epna_model
+from ga_epna_model import load_model, get_random_inputs, TORCHSCRIPT_MODEL_PATH, TORCH_INTRA_OP_THREADS, TORCH_INTER_OP_THREADS
+
+BENCHMARK_OUTPUT_PATH = getenv(
+    'BENCHMARK_OUTPUT_PATH', 'ga_epna_model_benchmark.json')
+
+# Inference backends of ga_epna_model, torchscript is skipped when the model is not exported.
+BENCHMARK_BACKENDS = getenv(
+    'BENCHMARK_BACKENDS', 'eager,quantized,torchscript').split(',')
+BENCHMARK_BATCH_SIZES = [int(batch_size) for batch_size in getenv(
+    'BENCHMARK_BATCH_SIZES', '1,32,256').split(',')]
+
+# Number of synthetic users predicted for each user shape.
+BENCHMARK_USERS = int(getenv('BENCHMARK_USERS', '512'))
+BENCHMARK_SESSIONS_COUNTS = [1, 2, 5, 12]
+BENCHMARK_MAX_HITS = [1, 4, 16, 30]
+WARMUP_BATCHES = 2
+
+# Every benchmark times this many batches, going over the synthetic users again
+# when they run out, so the latency percentiles have the same number of samples
+# at every batch size.
+BENCHMARK_TIMED_BATCHES = int(getenv('BENCHMARK_TIMED_BATCHES', '100'))
+
+# The benchmark measures CPU inference even when torch could use a GPU.
+ga_epna_model.device = tr.device('cpu')
+
+# Return the resident memory of this process in megabytes.
+def get_rss_mb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+# Benchmark one backend on synthetic users of a shape. It runs in a process of its
+# own so the peak memory of the process only covers this benchmark.
+def run_benchmark(backend, batch_size, sessions_count, max_hits):
+    np.random.seed(0)
+
+    tr.set_num_threads(TORCH_INTRA_OP_THREADS)
+    tr.set_num_interop_threads(TORCH_INTER_OP_THREADS)
+
+    start_rss = get_rss_mb()
+
+    # Keep the loading messages out of the results table.
+    with redirect_stdout(io.StringIO()):
+        model = load_model(backend)
+
+    inputs = get_random_inputs(BENCHMARK_USERS, sessions_count, max_hits)
+    batches = [{key: value[start: start + batch_size] for key, value in inputs.items()}
+               for start in range(0, BENCHMARK_USERS, batch_size)]
+
+    warmup_batches = batches[:WARMUP_BATCHES]
+    timed_batches = [batches[i % len(batches)]
+                     for i in range(BENCHMARK_TIMED_BATCHES)]
+
+    latencies = []
+    timed_users = 0
+
+    with tr.no_grad():
+        for i, batch in enumerate(warmup_batches + timed_batches):
+            # forward changes its inputs in place so the model gets a copy.
+            batch = {key: value.copy() for key, value in batch.items()}
+
+            start = perf_counter()
+            model.npForward(batch)
+
+            if i >= len(warmup_batches):
+                latencies.append(perf_counter() - start)
+                timed_users += len(batch['dataUsers'])
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+    return {
+        'backend': backend,
+        'batch_size': batch_size,
+        'sessions': sessions_count,
+        'max_hits': max_hits,
+        'users': BENCHMARK_USERS,
+        'timed_batches': len(latencies),
+        'users_per_second': timed_users / sum(latencies),
+        'p50_latency_ms': float(np.percentile(latencies, 50)) * 1000,
+        'p99_latency_ms': float(np.percentile(latencies, 99)) * 1000,
+        'peak_rss_mb': peak_rss,
+        'peak_rss_increase_mb': peak_rss - start_rss,
+    }
+
+
+def main():
+    backends = BENCHMARK_BACKENDS
+
+    if 'torchscript' in backends and not exists(TORCHSCRIPT_MODEL_PATH):
+        print('Skipping the torchscript backend, %s does not exist' %
+              TORCHSCRIPT_MODEL_PATH)
+        backends = [backend for backend in backends if backend != 'torchscript']
+
+    results = []
+
+    print('%-12s %6s %9s %9s %12s %10s %10s %10s' % ('backend', 'batch', 'sessions',
+                                                   'max hits', 'users/sec', 'p50 ms', 'p99 ms', 'peak MB'))
+
+    # A new process for every benchmark, the parent never runs the model
+    # so torch threads are never forked.
+    context = multiprocessing.get_context('fork')
+
+    for backend in backends:
+        for batch_size in BENCHMARK_BATCH_SIZES:
+            for sessions_count in BENCHMARK_SESSIONS_COUNTS:
+                for max_hits in BENCHMARK_MAX_HITS:
+                    with context.Pool(1) as pool:
+                        result = pool.apply(
+                            run_benchmark, (backend, batch_size, sessions_count, max_hits))
+
+                    print('%-12s %6d %9d %9d %12.0f %10.2f %10.2f %10.0f' % (
+                        backend, batch_size, sessions_count, max_hits, result['users_per_second'],
+                        result['p50_latency_ms'], result['p99_latency_ms'], result['peak_rss_mb']))
+
+                    results.append(result)
+
+    report = {
+        'torch_version': tr.__version__,
+        'python_version': platform.python_version(),
+        'processor': platform.processor(),
+        'intra_op_threads': TORCH_INTRA_OP_THREADS,
+        'inter_op_threads': TORCH_INTER_OP_THREADS,
+        'results': results,
+    }
+
+    with open(BENCHMARK_OUTPUT_PATH, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+
+    print('Saved the benchmark results to %s' % BENCHMARK_OUTPUT_PATH)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+from os import getenv, remove
+import sys
+
+import numpy as np
+import torch as tr
+
+from ga_epna_model import load_eager_model, get_random_inputs, TorchScriptModel, TORCHSCRIPT_MODEL_PATH
+
+# (users, sessions, max hits per session) of the batches the exported model is checked on.
+CHECK_BATCH_SHAPES = [(1, 1, 1), (16, 2, 4), (64, 5, 30), (8, 12, 2)]
+CHECK_TOLERANCE = float(getenv('CHECK_TOLERANCE', '1e-5'))
+
+# Trace the eager model on an example batch and save the TorchScript graph. The graph
+# has no data dependent control flow so it runs on batches of any shape.
+def export_torchscript(model, path):
+    example_inputs = model.getTrData(get_random_inputs(4, 3, 5))
+
+    with tr.no_grad():
+        traced_model = tr.jit.trace(
+            model, (example_inputs,), check_trace=False)
+
+    tr.jit.save(traced_model, path)
+    print("Saved TorchScript model to %s" % (path))
+
+# Return the largest difference between the eager and the exported model outputs.
+def check_torchscript(eager_model, torchscript_model):
+    max_difference = 0.0
+
+    for users_count, sessions_count, max_hits in CHECK_BATCH_SHAPES:
+        inputs = get_random_inputs(users_count, sessions_count, max_hits)
+
+        # forward changes its inputs in place so each model gets a copy.
+        with tr.no_grad():
+            eager_result = eager_model.npForward(
+                {key: value.copy() for key, value in inputs.items()})
+            torchscript_result = torchscript_model.npForward(
+                {key: value.copy() for key, value in inputs.items()})
+
+        difference = np.abs(eager_result - torchscript_result).max()
+
+        print('Users: %d, sessions: %d, max hits: %d, max difference: %g' %
+              (users_count, sessions_count, max_hits, difference))
+
+        max_difference = max(max_difference, difference)
+
+    return max_difference
+
+
+def main():
+    np.random.seed(0)
+
+    eager_model = load_eager_model()
+
+    export_torchscript(eager_model, TORCHSCRIPT_MODEL_PATH)
+
+    max_difference = check_torchscript(
+        eager_model, TorchScriptModel(TORCHSCRIPT_MODEL_PATH))
+
+    # Do not leave a model that does not match behind for batch inference.
+    if max_difference > CHECK_TOLERANCE:
+        remove(TORCHSCRIPT_MODEL_PATH)
+        print('TorchScript model differs from the eager model by %g, removed it' %
+              max_difference)
+        sys.exit(1)
+
+    print('TorchScript model matches the eager model')
+
+
+if __name__ == '__main__':
+    main()
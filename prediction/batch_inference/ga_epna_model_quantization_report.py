@@ -0,0 +1,136 @@
+from os import getenv
+from time import time
+import sys
+
+from cassandra.cluster import Cluster
+from cassandra.auth import PlainTextAuthProvider
+
+import numpy as np
+from pyspark.sql import Row
+import torch as tr
+
+from ga_epna_model import load_eager_model, quantize_model
+from ga_epna_batch_inference import get_bucket, get_batch_inputs
+
+MORPHL_SERVER_IP_ADDRESS = getenv('MORPHL_SERVER_IP_ADDRESS')
+MORPHL_CASSANDRA_USERNAME = getenv('MORPHL_CASSANDRA_USERNAME')
+MORPHL_CASSANDRA_PASSWORD = getenv('MORPHL_CASSANDRA_PASSWORD')
+MORPHL_CASSANDRA_KEYSPACE = getenv('MORPHL_CASSANDRA_KEYSPACE')
+
+CASS_REQ_TIMEOUT = 3600.0
+
+# .npz file with the model inputs of a held-out batch. When it is not set, the
+# held-out batch is a sample of the users in ga_epna_batch_inference_data.
+HELD_OUT_BATCH_PATH = getenv('HELD_OUT_BATCH_PATH')
+HELD_OUT_SAMPLE_SIZE = int(getenv('HELD_OUT_SAMPLE_SIZE', '2048'))
+
+THROUGHPUT_REPEATS = 10
+
+OUTPUT_NAMES = [
+    'all_visits',
+    'product_view',
+    'add_to_cart',
+    'checkout_with_add_to_cart',
+    'checkout_without_add_to_cart',
+    'transaction',
+]
+
+# Return the model inputs of a sample of the users in ga_epna_batch_inference_data,
+# one batch per bucket of users with the same number of sessions. The first users
+# in token order are taken, which spreads the sample over the client ids.
+def sample_batch_inference_data():
+    auth_provider = PlainTextAuthProvider(
+        username=MORPHL_CASSANDRA_USERNAME,
+        password=MORPHL_CASSANDRA_PASSWORD
+    )
+
+    cluster = Cluster(
+        [MORPHL_SERVER_IP_ADDRESS], auth_provider=auth_provider)
+
+    session = cluster.connect(MORPHL_CASSANDRA_KEYSPACE)
+
+    select_sql = ('SELECT client_id, user_features, sessions_features, hits_features, '
+                  'sessions_hits_count, shopping_stages, tensor_shapes '
+                  'FROM ga_epna_batch_inference_data LIMIT %d' % HELD_OUT_SAMPLE_SIZE)
+
+    buckets = {}
+
+    for row in session.execute(select_sql, timeout=CASS_REQ_TIMEOUT):
+        row = Row(**row._asdict())
+        buckets.setdefault(get_bucket(row), []).append(row)
+
+    cluster.shutdown()
+
+    return [get_batch_inputs(rows) for rows in buckets.values()]
+
+# Return the held-out batches of model inputs, from HELD_OUT_BATCH_PATH or sampled
+# from Cassandra. The report is only meaningful on real users so it stops when
+# there are none.
+def load_held_out_batches():
+    if HELD_OUT_BATCH_PATH is not None:
+        with np.load(HELD_OUT_BATCH_PATH) as held_out_batch:
+            return [{key: held_out_batch[key] for key in held_out_batch.files}]
+
+    if MORPHL_SERVER_IP_ADDRESS is None:
+        print('No held-out batch: set HELD_OUT_BATCH_PATH to an .npz file of model inputs '
+              'or the Cassandra settings to sample ga_epna_batch_inference_data')
+        sys.exit(1)
+
+    batches = sample_batch_inference_data()
+
+    if not batches:
+        print('No held-out batch: ga_epna_batch_inference_data is empty')
+        sys.exit(1)
+
+    return batches
+
+# Return the predictions for the most recent session of each user.
+def predict(model, batches):
+
+    # forward changes its inputs in place so the model gets a copy.
+    with tr.no_grad():
+        results = [model.npForward({key: value.copy() for key, value in inputs.items()})
+                   for inputs in batches]
+
+    return np.concatenate([result[:, -1] for result in results])
+
+# Return the number of users per second the model makes predictions for.
+def measure_throughput(model, batches):
+    predict(model, batches)
+
+    start = time()
+    for _ in range(THROUGHPUT_REPEATS):
+        predict(model, batches)
+
+    users_count = sum(len(inputs['dataUsers']) for inputs in batches)
+
+    return THROUGHPUT_REPEATS * users_count / (time() - start)
+
+
+def main():
+    batches = load_held_out_batches()
+
+    float_model = load_eager_model()
+    quantized_model = quantize_model(float_model)
+
+    float_predictions = predict(float_model, batches)
+    quantized_predictions = predict(quantized_model, batches)
+
+    differences = np.abs(float_predictions - quantized_predictions)
+
+    # Users whose prediction would be counted differently in the statistics.
+    flips = (float_predictions > 0.5) != (quantized_predictions > 0.5)
+
+    print('Accuracy of int8 against float32 on %d users' % len(float_predictions))
+    print('%-30s %12s %12s %12s' % ('output', 'mean diff', 'max diff', 'flips'))
+
+    for i, output_name in enumerate(OUTPUT_NAMES):
+        print('%-30s %12.6f %12.6f %12d' % (output_name,
+                                           differences[:, i].mean(), differences[:, i].max(), flips[:, i].sum()))
+
+    print('Throughput float32: %.0f users/sec, int8: %.0f users/sec' %
+          (measure_throughput(float_model, batches), measure_throughput(quantized_model, batches)))
+
+
+if __name__ == '__main__':
+    main()
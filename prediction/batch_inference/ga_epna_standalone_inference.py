@@ -0,0 +1,243 @@
+from os import getenv
+from time import time, process_time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+
+from cassandra.cluster import Cluster
+from cassandra.auth import PlainTextAuthProvider
+from cassandra.concurrent import execute_concurrent_with_args
+
+import numpy as np
+from pyspark.sql import Row
+
+from ga_epna_model import get_model, CPU_CORES, INFERENCE_TASK_SLOTS, TORCH_INTRA_OP_THREADS, TORCH_INTER_OP_THREADS
+from ga_epna_batch_inference import (get_bucket, predict_batch, insert_statistics, INFERENCE_BATCH_SIZE,
+                                     SHOPPING_STAGES, HISTOGRAM_BINS, PROBABILITY_QUANTILES,
+                                     STATEFUL_INFERENCE, INFERENCE_RESULT_CACHE)
+
+MORPHL_SERVER_IP_ADDRESS = getenv('MORPHL_SERVER_IP_ADDRESS')
+MORPHL_CASSANDRA_USERNAME = getenv('MORPHL_CASSANDRA_USERNAME')
+MORPHL_CASSANDRA_PASSWORD = getenv('MORPHL_CASSANDRA_PASSWORD')
+MORPHL_CASSANDRA_KEYSPACE = getenv('MORPHL_CASSANDRA_KEYSPACE')
+
+CASS_REQ_TIMEOUT = 3600.0
+
+PREDICTION_DAY_AS_STR = getenv('PREDICTION_DAY_AS_STR')
+
+# The token ring of the Murmur3 partitioner is split into this many ranges,
+# READ_CONCURRENCY of them are read at the same time.
+TOKEN_RANGES_COUNT = int(getenv('TOKEN_RANGES_COUNT', '64'))
+READ_CONCURRENCY = int(getenv('READ_CONCURRENCY', '4'))
+MIN_TOKEN = -2 ** 63
+MAX_TOKEN = 2 ** 63 - 1
+
+# Maximum number of inserts in flight for each mini-batch of predictions.
+WRITE_CONCURRENCY = int(getenv('WRITE_CONCURRENCY', '64'))
+
+# Mini-batches waiting for a model worker, so reading does not run ahead of inference.
+MAX_PENDING_BATCHES = 2 * INFERENCE_TASK_SLOTS
+
+BATCH_INFERENCE_DATA_COLUMNS = ['client_id', 'user_features', 'sessions_features', 'hits_features',
+                                'sessions_hits_count', 'shopping_stages', 'tensor_shapes']
+
+
+def get_cassandra_session():
+    auth_provider = PlainTextAuthProvider(
+        username=MORPHL_CASSANDRA_USERNAME,
+        password=MORPHL_CASSANDRA_PASSWORD
+    )
+
+    cluster = Cluster(
+        [MORPHL_SERVER_IP_ADDRESS], auth_provider=auth_provider)
+
+    return cluster.connect(MORPHL_CASSANDRA_KEYSPACE)
+
+# Return the (start, end] token ranges the token ring is split into.
+def get_token_ranges():
+    bounds = np.linspace(MIN_TOKEN, MAX_TOKEN, TOKEN_RANGES_COUNT + 1)
+    bounds = [MIN_TOKEN] + [int(bound) for bound in bounds[1:-1]] + [MAX_TOKEN]
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# Read the batch inference data of the users from the current day of predictions in a
+# token range. Both tables are partitioned by client_id so they share the token range.
+def read_token_range(session, statements, token_range):
+    current_day_ids = {row.client_id for row in session.execute(
+        statements['current_day_ids'], (*token_range, PREDICTION_DAY_AS_STR), timeout=CASS_REQ_TIMEOUT)}
+
+    if not current_day_ids:
+        return []
+
+    # Row objects like on the Spark runner, so the same prediction functions apply.
+    return [Row(**dict(row._asdict(), tensor_shapes=dict(row.tensor_shapes))) for row in session.execute(
+        statements['batch_inference_data'], token_range, timeout=CASS_REQ_TIMEOUT)
+        if row.client_id in current_day_ids]
+
+# Read the batch inference data of the current day of predictions, READ_CONCURRENCY
+# token ranges at a time.
+def read_batch_inference_data(session, statements):
+    with ThreadPoolExecutor(READ_CONCURRENCY) as executor:
+        pending = deque()
+
+        for token_range in get_token_ranges():
+            pending.append(executor.submit(
+                read_token_range, session, statements, token_range))
+
+            if len(pending) == READ_CONCURRENCY:
+                yield from pending.popleft().result()
+
+        while pending:
+            yield from pending.popleft().result()
+
+# Group the users into buckets like get_partition_predictions does and return
+# full buckets as soon as they fill up, then the partially filled ones.
+def get_mini_batches(rows):
+    buckets = {}
+
+    for row in rows:
+        bucket_key = get_bucket(row)
+        bucket = buckets.setdefault(bucket_key, [])
+        bucket.append(row)
+
+        if len(bucket) == INFERENCE_BATCH_SIZE:
+            yield bucket
+            buckets[bucket_key] = []
+
+    for bucket in buckets.values():
+        if bucket:
+            yield bucket
+
+# Task slot of a model worker, set when the worker starts.
+task_slot = None
+
+# Load times of the model of this worker that were not reported yet.
+model_load_seconds = []
+
+# Pool initializer that takes the task slot of the worker from a queue.
+def init_model_worker(task_slots):
+    global task_slot
+    task_slot = task_slots.get()
+
+# Make the predictions for a mini-batch in a model worker. The model is loaded by
+# the first mini-batch of each worker. The CPU time the worker used and the model
+# load times are returned with the predictions.
+def predict_mini_batch(rows):
+    start_cpu_time = process_time()
+
+    model = get_model(model_load_seconds.append, task_slot)
+    predictions = list(predict_batch(model, rows))
+
+    load_seconds = list(model_load_seconds)
+    model_load_seconds.clear()
+
+    return predictions, process_time() - start_cpu_time, load_seconds
+
+# Calculate the same statistics as calculate_statistics for the (users, stages)
+# array of probabilities.
+def calculate_statistics(probabilities):
+    statistics = {'total_predictions': len(probabilities)}
+
+    for i, stage in enumerate(SHOPPING_STAGES):
+        statistics[stage] = int((probabilities[:, i] > 0.5).sum())
+
+    histogram_bins = np.minimum(
+        np.floor(probabilities * HISTOGRAM_BINS), HISTOGRAM_BINS - 1).astype(np.int64)
+
+    statistics['probability_histograms'] = {
+        stage: np.bincount(histogram_bins[:, i], minlength=HISTOGRAM_BINS).tolist()
+        for i, stage in enumerate(SHOPPING_STAGES)}
+    statistics['probability_quantiles'] = {
+        stage: np.quantile(probabilities[:, i], PROBABILITY_QUANTILES).tolist() if len(probabilities) else []
+        for i, stage in enumerate(SHOPPING_STAGES)}
+
+    return statistics
+
+
+def main():
+    if STATEFUL_INFERENCE or INFERENCE_RESULT_CACHE:
+        raise Exception('Stateful inference and the result cache are only supported by the Spark runner')
+
+    # Start the model workers before the Cassandra driver starts its threads.
+    task_slots = multiprocessing.Queue()
+    for slot in range(INFERENCE_TASK_SLOTS):
+        task_slots.put(slot)
+
+    pool = multiprocessing.Pool(INFERENCE_TASK_SLOTS, init_model_worker, (task_slots,))
+
+    session = get_cassandra_session()
+
+    token_range_condition = 'token(client_id) > ? AND token(client_id) <= ?'
+
+    statements = {
+        'current_day_ids': session.prepare(
+            'SELECT client_id FROM ga_epnau_features_raw WHERE {} AND day_of_data_capture = ? ALLOW FILTERING'.format(
+                token_range_condition)),
+        'batch_inference_data': session.prepare(
+            'SELECT {} FROM ga_epna_batch_inference_data WHERE {}'.format(
+                ', '.join(BATCH_INFERENCE_DATA_COLUMNS), token_range_condition)),
+        'predictions': session.prepare(
+            'INSERT INTO ga_epna_predictions (client_id, {}, prediction_date) VALUES ({})'.format(
+                ', '.join(SHOPPING_STAGES), ', '.join(['?'] * (len(SHOPPING_STAGES) + 2)))),
+    }
+
+    print('Core budget: %d cores, %d model workers, %d intra-op and %d inter-op torch threads per worker' %
+          (CPU_CORES, INFERENCE_TASK_SLOTS, TORCH_INTRA_OP_THREADS, TORCH_INTER_OP_THREADS))
+
+    probabilities = []
+    load_seconds = []
+    inference_cpu_seconds = 0.0
+
+    # Save a mini-batch of predictions with at most WRITE_CONCURRENCY inserts in flight.
+    def save_predictions(result):
+        nonlocal inference_cpu_seconds
+
+        predictions, cpu_seconds, batch_load_seconds = result
+
+        execute_concurrent_with_args(
+            session, statements['predictions'], predictions, concurrency=WRITE_CONCURRENCY)
+
+        probabilities.extend(prediction[1: len(SHOPPING_STAGES) + 1] for prediction in predictions)
+        load_seconds.extend(batch_load_seconds)
+        inference_cpu_seconds += cpu_seconds
+
+    start = time()
+
+    with pool:
+        pending = deque()
+
+        for mini_batch in get_mini_batches(read_batch_inference_data(session, statements)):
+            pending.append(pool.apply_async(predict_mini_batch, (mini_batch,)))
+
+            if len(pending) == MAX_PENDING_BATCHES:
+                save_predictions(pending.popleft().get())
+
+        while pending:
+            save_predictions(pending.popleft().get())
+
+    inference_seconds = time() - start
+
+    statistics = calculate_statistics(
+        np.array(probabilities, dtype=np.float64).reshape(-1, len(SHOPPING_STAGES)))
+
+    statistics.update({
+        'model_loads': len(load_seconds),
+        'model_load_seconds': sum(load_seconds),
+        'inference_seconds': inference_seconds,
+        'cpu_efficiency': inference_cpu_seconds / (inference_seconds * CPU_CORES),
+        'reused_predictions': 0,
+        'cache_hit_rate': 0.0,
+    })
+
+    print('Predictions: %d' % statistics['total_predictions'])
+    print('Model loads: %d, total load time: %.2fs' %
+          (statistics['model_loads'], statistics['model_load_seconds']))
+    print('Inference time: %.2fs, CPU efficiency: %.2f' %
+          (statistics['inference_seconds'], statistics['cpu_efficiency']))
+
+    # Save the statistics to Cassandra
+    insert_statistics(statistics)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,13 @@
 cp -r /opt/ga_epna /opt/code
 cd /opt/code
 
-spark-submit --jars /opt/spark/jars/spark-cassandra-connector.jar,/opt/spark/jars/jsr166e.jar /opt/code/prediction/batch_inference/ga_epna_batch_inference.py
+# The standalone runner makes the predictions without starting Spark.
+if [ "${INFERENCE_RUNNER}" == "standalone" ]; then
+  cd /opt/code/prediction/batch_inference
+  python /opt/code/prediction/batch_inference/ga_epna_standalone_inference.py
+else
+  spark-submit --jars /opt/spark/jars/spark-cassandra-connector.jar,/opt/spark/jars/jsr166e.jar \
+    --py-files /opt/code/prediction/batch_inference/ga_epna_model.py \
+    /opt/code/prediction/batch_inference/ga_epna_batch_inference.py
+fi
 
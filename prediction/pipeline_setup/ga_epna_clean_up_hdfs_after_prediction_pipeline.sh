@@ -4,6 +4,7 @@ HDFS_DIR_USER_FILTERED=hdfs://${MORPHL_SERVER_IP_ADDRESS}:${HDFS_PORT}/${PREDICT
 HDFS_DIR_SESSION_FILTERED=hdfs://${MORPHL_SERVER_IP_ADDRESS}:${HDFS_PORT}/${PREDICTION_DAY_AS_STR}_${UNIQUE_HASH}_ga_epnas_filtered
 HDFS_DIR_HIT_FILTERED=hdfs://${MORPHL_SERVER_IP_ADDRESS}:${HDFS_PORT}/${PREDICTION_DAY_AS_STR}_${UNIQUE_HASH}_ga_epnah_filtered
 HDFS_DIR_STAGES_FILTERED=hdfs://${MORPHL_SERVER_IP_ADDRESS}:${HDFS_PORT}/${PREDICTION_DAY_AS_STR}_${UNIQUE_HASH}_ga_epna_shopping_stages_filtered
+HDFS_DIR_ACTIVE_CLIENT_IDS=hdfs://${MORPHL_SERVER_IP_ADDRESS}:${HDFS_PORT}/${PREDICTION_DAY_AS_STR}_${UNIQUE_HASH}_ga_epna_active_client_ids
 
 hdfs dfs -rm ${HDFS_DIR_USER_FILTERED}/*
 hdfs dfs -rmdir ${HDFS_DIR_USER_FILTERED}
@@ -17,4 +18,7 @@ hdfs dfs -rmdir ${HDFS_DIR_HIT_FILTERED}
 hdfs dfs -rm ${HDFS_DIR_STAGES_FILTERED}/*
 hdfs dfs -rmdir ${HDFS_DIR_STAGES_FILTERED}
 
+hdfs dfs -rm ${HDFS_DIR_ACTIVE_CLIENT_IDS}/*
+hdfs dfs -rmdir ${HDFS_DIR_ACTIVE_CLIENT_IDS}
+
 exit 0
\ No newline at end of file
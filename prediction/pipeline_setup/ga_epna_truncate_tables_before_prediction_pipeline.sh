@@ -1,4 +1,10 @@
 cqlsh ${MORPHL_SERVER_IP_ADDRESS} -u morphl -p ${MORPHL_CASSANDRA_PASSWORD} \
   -f /opt/ga_epna/prediction/pipeline_setup/ga_epna_truncate_tables_before_prediction_pipeline.cql
 
+# With the incremental feature store, users without new sessions keep their inference data.
+if [ "${INCREMENTAL_FEATURE_STORE}" != "true" ]; then
+  cqlsh ${MORPHL_SERVER_IP_ADDRESS} -u morphl -p ${MORPHL_CASSANDRA_PASSWORD} \
+    -e "TRUNCATE TABLE morphl.ga_epna_batch_inference_data;"
+fi
+
 exit 0